@@ -1,19 +1,48 @@
+import hashlib
 import json
 import os
 import pprint as pp
+import re
+import threading
+import time
+from contextlib import contextmanager
 from typing import Union
-import openai
-from openai.openai_object import OpenAIObject
-import tiktoken
-from .logger import logger
+from .analytics import JobFrame
+from .config_store import get_store
+from .backends import CompletionBackend, get_backend
+from .handles import RequestHandle, ResponseTimeout
+from .ledger import BudgetExceeded, BudgetGuard, CostLedger
+from .listing import JobListing
+from .metrics import API_LATENCY, CACHE, COST, LETTERS, ORPHANED, PERSIST, TOKENS
+from .logger import log_event, logger
+from .pricing import cost_for, estimate_cost
+from .prompt import PromptCache
+from .records import JobRecord
+from .response_cache import ResponseCache, cache_key
+from .storage import file_lock, file_stamp, get_storage, migrate_json
+from .scheduler import RequestScheduler, default_scheduler
+from .similarity import SimilarityIndex
+from .tokens import count_tokens
 
 pp.PrettyPrinter(indent=4, compact=False, width=100)
 printf = pp.pformat
 
+MODEL = "gpt-3.5-turbo"
+TEMPERATURE = 0
+
+def normalize(value) -> str:
+    """
+    Collapse whitespace and case so trivially different strings compare equal.
+    """
+    return " ".join(str(value or "").split()).lower()
+
+
+TYPE_NAMES = {"int": int, "float": float, "str": str, "bool": bool, "list": list, "dict": dict}
+
 class Schema:
     def __init__(self, schema_config=None):
+        self.mlog = logger
         if not schema_config:
-            self.mlog = logger
             self.schema = \
             [
                 {
@@ -29,78 +58,218 @@ class Schema:
                     "response_model": list,
                     "response_timestamp": list,
                     "response_cost": list,
-                    "total_cost": int 
+                    "response_config": list,
+                    "total_cost": float,
+                    "prompt_tokens_before": int,
+                    "prompt_tokens_after": int,
+                    "similar_to": list,
                     }
                 ] 
         else:
             with open(schema_config, 'r') as schema_file:
                 self.schema = json.load(schema_file)
+        self.compile()
+
+    def compile(self):
+        """
+        Resolve the schema into a field -> type map once, so validation doesn't have to look
+        anything up per value. Schemas loaded from a file name their types as strings.
+        """
+        self.types = {k: TYPE_NAMES[v] if isinstance(v, str) else v for k, v in self.schema[0].items()}
+        self.fields = frozenset(self.types)
+        # whole numbers are fine wherever a float is expected
+        self.checks = {k: (int, float) if v is float else v for k, v in self.types.items()}
+
+    def check_batch(self, rows:list) -> dict:
+        """
+        Validate a batch column by column and report every bad row instead of stopping at the first.
+
+        returns:
+            {
+                "valid": [rows that passed],
+                "invalid": [{"row": position in rows, "errors": [...], "item": row}, ...]
+            }
+        """
+        errors = {}
+        records = []
+        for n, row in enumerate(rows):
+            if isinstance(row, dict):
+                records.append((n, row))
+                unknown = row.keys() - self.fields
+                if unknown:
+                    errors.setdefault(n, []).extend(f"unknown key {k}" for k in sorted(unknown))
+            else:
+                errors[n] = [f"entry is a {type(row).__name__}, not a dict"]
+
+        for field, field_type in self.checks.items():
+            for n, row in records:
+                value = row.get(field, field_type)
+                if value is not field_type and not isinstance(value, field_type):
+                    errors.setdefault(n, []).append(
+                            f"{field} should be {self.types[field].__name__}, got {type(value).__name__}")
+
+        return {
+            "valid": [row for n, row in enumerate(rows) if n not in errors],
+            "invalid": [{"row": n, "errors": errs, "item": rows[n]} for n, errs in sorted(errors.items())],
+            }
+
     def validate_schema(self, case):
         """
-        TODO:
-            Write a schema validating function.
-        """
-        if isinstance(case, list):
-            for item in case:
-                if isinstance(item, dict):
-                    for k, v in item.items():
-                        try:
-                            # self.mlog.debug(f"\nk: {k}\nv: {v}")
-                            type_check = isinstance(v, self.schema[0][k])
-                        except KeyError as err:
-                            self.mlog.warn(f"Key: {k} not found in schema:\n{err}")
-                            return {"valid": False, "message": f"Validation failed with a KeyError for {k} in:\n{item}"}
-                        if not type_check:
-                            return {"valid": False, "message": f"Value type error for {k}: {v} in item:\n{item}"}
-                else:
-                    return {"valid": False, "message": f"All entries have to be a dictionaries:\n{item}"} 
-        else:
+        Check that case is a List[dict] matching the schema. The message describes the first bad row
+        and errors holds the report for every bad row.
+        """
+        if not isinstance(case, list):
             return {"valid": False, "message": f"Entries must be in the form List[dict]. The top level object passed is {type(case)}"}
 
+        invalid = self.check_batch(case)["invalid"]
+        if invalid:
+            first = invalid[0]
+            return {"valid": False,
+                    "message": f"{'; '.join(first['errors'])} in item:\n{first['item']}",
+                    "errors": invalid}
+
         return {"valid": True, "message": "Looks like it's valid"}
 
-class QueryData(list):
+class QueryData:
     def __init__(self, 
                  db_path:Union[str, os.PathLike],
-                 schema_config:Union[str, os.PathLike, None]=None):
+                 schema_config:Union[str, os.PathLike, None]=None,
+                 storage=None,
+                 similarity:bool=True):
+        """
+        storage is the backend that reads and writes the records. By default it is picked from the
+        extension of db_path, see storage.get_storage. A .jsonl database that doesn't exist yet is
+        started from the .json file of the same name, see storage.migrate_json.
+
+        similarity keeps a MinHash index of the job descriptions in a .minhash file next to the
+        database. New postings that nearly match stored ones get their indexes in similar_to, and
+        LetterMaker.get_letter can reuse the letters of those matches.
+
+        The records are JobRecords in self.data, ordered by index. With the .jsonl storage their
+        descriptions and letters stay on disk until they are read.
+        """
         self.db_path = db_path
         self.mlog = logger
+        if storage is None:
+            migrate_json(db_path)
+        self.storage = storage or get_storage(db_path)
+        self.similarity = SimilarityIndex(f"{os.path.splitext(db_path)[0]}.minhash") if similarity else None
+        self.lock = threading.RLock()
+        self.stamp = file_stamp(db_path)
         self.data = self._load_dataset(db_path)
         self._schema = Schema(schema_config)
-        self.schema = Schema(schema_config).schema
+        self.schema = self._schema.schema
         self.validate = self._schema.validate_schema
+        self.quarantine = []
+        self._job_frame = JobFrame(self.data)
+        self._listing = None
+
+    def is_stale(self) -> bool:
+        """
+        True when the database file changed since this object last read or wrote it.
+        """
+        return file_stamp(self.db_path) != self.stamp
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def __getitem__(self, index):
+        return self.data[index]
+
+    @contextmanager
+    def _write_lock(self):
+        """
+        Hold the database for a read-modify-write. If another process wrote to it since we last
+        looked, the records are reloaded first so its changes aren't overwritten.
+        """
+        with self.lock, file_lock(self.db_path):
+            if self.is_stale():
+                self.mlog.info(f"{self.db_path} was changed by another writer, reloading before the update")
+                self.reload()
+            yield
+
+    def reload(self):
+        """
+        Re-read the database in place, so references to self.data stay valid.
+        """
+        with self.lock:
+            self.stamp = file_stamp(self.db_path)
+            self.data[:] = self._load_dataset(self.db_path)
+            self._job_frame.invalidate()
+
+    @property
+    def frame(self) -> JobFrame:
+        """
+        Polars view of the records for aggregate queries, e.g. data_obj.frame.spend_by_model().
+        """
+        return self._job_frame
+
+    @property
+    def listing(self) -> JobListing:
+        """
+        Paged, filtered listing rows for the web app, see listing.JobListing.
+        """
+        if self._listing is None:
+            self._listing = JobListing(self)
+        return self._listing
 
     def _load_dataset(self, file_path):
         """
         The purpose of this function is to import the dataset of all jobs data contained in the data
-        folder.
+        folder. The dedup index is built as the records are read, before their large fields are
+        left on disk.
         """
+        keys = {}
+        def visit(record):
+            keys[record['index']] = self._dedup_key(record)
+
         if os.path.exists(file_path):
-            print("test")
-            self.mlog.info(f"Found a file at path: {file_path}")
-            with open(file_path, "r") as db_file:
-                data = json.load(db_file)
+            self.mlog.info("Found a file at path: %s", file_path)
+            with file_lock(file_path, shared=True):
+                data = self.storage.load_records(visit)
+            self._dedup_index = {key: idx for idx, key in keys.items()}
             return sorted(data, key=lambda x: x['index'])
         else:
+            self._dedup_index = {}
             return []
 
     def add_entries(self, entries:Union[str, os.PathLike, list, None]=None):
+        """
+        Validate and insert new entries. Rows that fail validation are set aside in self.quarantine
+        and appended to a .quarantine.jsonl file next to the database, the rest are inserted.
 
+        Returns the number of rows inserted and quarantined.
+        """
         if isinstance(entries, str):
             entries = self._check_string(entries)
         if isinstance(entries, list):
-            check = self.validate(entries)
+            report = self._schema.check_batch(entries)
         else:
-            return
+            return {"inserted": 0, "quarantined": 0}
 
-        if check['valid']:
-            for item in entries: 
-                for k, v in self.schema[0].items():
-                    item.setdefault(k, v())
-            self.insert_entries(entries)
-        else:
-            self.mlog.warn(f"Data validation failed with message:\n{check}")
-        return
+        if report['invalid']:
+            self.mlog.warning(f"Quarantined {len(report['invalid'])} of {len(entries)} entries, "
+                              f"first error: {report['invalid'][0]['errors']}")
+            self._quarantine(report['invalid'])
+
+        valid = report['valid']
+        for item in valid: 
+            for k, v in self._schema.types.items():
+                item.setdefault(k, v())
+        inserted = self.insert_entries(valid) if valid else []
+        return {"inserted": len(inserted), "quarantined": len(report['invalid'])}
+
+    def _quarantine(self, invalid:list):
+        self.quarantine.extend(invalid)
+        path = f"{os.path.splitext(self.db_path)[0]}.quarantine.jsonl"
+        try:
+            with open(path, 'a') as q_file:
+                q_file.write("".join(json.dumps(bad, default=str) + "\n" for bad in invalid))
+        except OSError as err:
+            self.mlog.exception(f"could not write quarantined rows to {path}:\n{err}")
             
             
     def _check_string(self, string):
@@ -120,34 +289,82 @@ class QueryData(list):
                 return
         return data
 
+    @staticmethod
+    def _dedup_key(entry:dict) -> tuple:
+        """
+        Key used to spot postings that are already in the database: the company and job title with
+        whitespace and case normalized, plus a hash of the normalized description.
+        """
+        description = hashlib.sha1(normalize(entry.get('job_description')).encode()).digest()
+        return (normalize(entry.get('company')), normalize(entry.get('job_title')), description)
+
+    def lookup(self, entry:dict) -> Union[int, None]:
+        """
+        Return the index of the stored posting matching entry, or None.
+        """
+        return self._dedup_index.get(self._dedup_key(entry))
+
     def _index_new_entries(self, entries):
-        current_companies = [k[0].strip() for k in [list(x.values()) for x in self.data]]
-        new_company_names = [k[0].strip() for k in [list(x.values()) for x in entries]]
-        idx_rm = []
-        for name in current_companies:
-            try:
-                idx = new_company_names.index(name)
-            except ValueError:
+        new_entries = []
+        seen = set()
+        for entry in entries:
+            key = self._dedup_key(entry)
+            if key in self._dedup_index or key in seen:
+                self.mlog.debug("Skipping duplicate posting: %s - %s", entry.get('company'), entry.get('job_title'))
                 continue
-            new_company_names.pop(idx)
-            entries.pop(idx)
-        return entries
+            seen.add(key)
+            new_entries.append(entry)
+        return new_entries
 
     def insert_entries(self, entries):
+        with self._write_lock():
+            return self._insert_entries(entries)
+
+    def near_duplicates(self, entry:dict, threshold:Union[float, None]=None) -> list:
+        """
+        Stored postings whose description nearly matches entry's, as (index, similarity) pairs with
+        the closest first. Empty when the similarity index is off.
+        """
+        if self.similarity is None:
+            return []
+        with self.lock:
+            self.similarity.sync(self.data)
+            matches = self.similarity.query(entry.get('job_description'), threshold=threshold,
+                                            exclude=entry.get('index'))
+            self.similarity.save()
+        return matches
+
+    def _insert_entries(self, entries):
         entries = self._index_new_entries(entries)
-        idx_range = list(range(len(self.data)))
-        entry_idx = list(range(len(self.data), len(self.data) + len(entries)))
-        self.mlog.debug(f"entry indexes: {entry_idx}")
-        self.mlog.info(f"New entry range {idx_range}.extend({entry_idx})")
+        if self.similarity is not None:
+            self.similarity.sync(self.data)
+        idx_range = range(len(self.data))
+        entry_idx = range(len(self.data), len(self.data) + len(entries))
+        inserted = []
+        self.mlog.info("New entry range %s.extend(%s)", idx_range, entry_idx)
         for idx, entry in zip(entry_idx, entries):
             if idx in idx_range:
                 self.mlog.warning(f"Skipping:\n{entry['company']}\nindex: {idx}\nFound entry index in self.data.")
                 continue
             entry['index'] = idx
-            self.data.append(entry)
-        response = self.save_updates("add")
-        self.mlog.info(f"message: {response['message']}")
-        # return self.data
+            if self.similarity is not None:
+                signature = self.similarity.signature(entry.get('job_description'))
+                if signature is not None:
+                    entry['similar_to'] = [match for match, _ in self.similarity.query(signature=signature)]
+                    if entry['similar_to']:
+                        self.mlog.info("%s - %s looks like a repost of %s", entry.get('company'),
+                                       entry.get('job_title'), entry['similar_to'])
+                    self.similarity.add(idx, None, signature)
+            record = JobRecord.from_dict(entry)
+            self.data.append(record)
+            self._dedup_index[self._dedup_key(entry)] = idx
+            inserted.append(record)
+        self._job_frame.invalidate(entry['index'] for entry in inserted)
+        response = self.save_updates("add", inserted)
+        if self.similarity is not None:
+            self.similarity.save()
+        self.mlog.info("message: %s", response['message'])
+        return inserted
             
     
     def update_entries(self, updates):
@@ -155,37 +372,61 @@ class QueryData(list):
         This function will recieve a report back from letter maker after each round of quieres and
         use that report to update the database.
         """
+        with self._write_lock():
+            self._update_entries(updates)
+
+    def _update_entries(self, updates):
+        changed = []
         for item in updates:
             if item['response_text'] == "Request Failed":
                 continue
-            self.mlog.debug(f"\nupdating entries for:\nitem['index']: {item['index']}")
+            self.mlog.debug("updating index %s fields %s", item['index'], list(item))
+            record = self.data[item['index']]
+            # a response list added to the schema later starts with a null for each older response
+            earlier = len(record.get('response_text') or [])
             for k, v in item.items():
-                self.mlog.debug(f"\ndata[item['index']]:\n{k} => {v}")
-                if isinstance(self.data[item['index']][k], list):
-                    self.data[item['index']][k].append(v)
+                if k not in record and self._schema.types.get(k) is list:
+                    current = [None] * earlier
                 else:
-                    self.data[item['index']][k] = v
-            self.mlog.debug(f"self.data[idx]['response_cost']:\n{self.data[item['index']]['response_cost']}") 
-            self.data[item['index']]['response_count'] = len(self.data[item['index']]['response_text'])
-            self.data[item['index']]['total_cost'] = sum(self.data[item['index']]['response_cost'])
+                    current = record.get(k)
+                # assigned rather than appended to, lazy fields are read fresh from disk each time
+                record[k] = current + [v] if isinstance(current, list) else v
+            record['response_count'] = len(record['response_text'])
+            record['total_cost'] = sum(record['response_cost'])
+            changed.append(record)
 
-        response = self.save_updates("update")
-        self.mlog.info(f"\nresponse: {response['message']}")
+        self._job_frame.invalidate(record['index'] for record in changed)
+        response = self.save_updates("update", changed)
+        self.mlog.info("response: %s", response['message'])
 
-    def save_updates(self, request:str):
+    def save_updates(self, request:str, changed:Union[list, None]=None):
+        """
+        Persist the records in changed, or every record when changed is None. How much actually
+        gets written depends on the storage backend.
+        """
         try:
-            with open(self.db_path, 'w') as db_file:
-                json.dump(self.data, db_file, indent=4)
+            with PERSIST.time(), file_lock(self.db_path):
+                self.storage.save(self.data, changed)
+                self.stamp = file_stamp(self.db_path)
         except Exception as err: 
-           self.mlog.exception(f"encountered exception while processing {request}:\n{err}")
+            self.mlog.exception(f"encountered exception while processing {request}:\n{err}")
+            return {'message': f"{request} failed: {err}"}
 
         return {'message': f"{request} was successful"}
         
 class LetterMaker:
     def __init__(self, 
-                 data_dir:str="./job_data.json",
+                 data_dir:str="./job_data.jsonl",
                  config_path:str='./config.json', 
-                 config_name:Union[str, None]="default"):
+                 config_name:Union[str, None]="default",
+                 scheduler:Union[RequestScheduler, None]=None,
+                 timeout:float=120.0,
+                 response_cache:Union[ResponseCache, bool, None]=True,
+                 backend:Union[CompletionBackend, None]=None,
+                 prompt_budget:Union[int, None]=3000,
+                 ledger:Union[CostLedger, bool, None]=True,
+                 daily_budget:Union[float, None]=None,
+                 reuse_threshold:float=0.9):
         """
         config file:
             {
@@ -203,14 +444,71 @@ class LetterMaker:
                     ],
                     ...
                     }
+
+        scheduler is the rate limiter that every query goes through. Makers share the process wide
+        default scheduler unless one is passed in.
+
+        timeout is the deadline in seconds for a single query. A job that takes longer is recorded
+        as failed.
+
+        response_cache stores answered prompts so identical requests are not billed twice. True
+        opens response_cache.db next to the job database, False or None turns caching off.
+
+        backend answers the completion requests, see backends.get_backend for the default.
+
+        prompt_budget caps the prompt tokens sent per job. Longer job descriptions are compacted to
+        fit, see prompt.compact_description. A config can override it with a prompt_budget key,
+        and None turns compaction off.
+
+        ledger records the cost of every letter. True opens cost_ledger.db next to the job
+        database. daily_budget caps the spend per calendar day across every batch in the ledger.
+
+        reuse_threshold is the estimated similarity a stored posting needs before get_letter will
+        reuse its letter, see get_letter's reuse argument.
         """
+        self.mlog = logger
+        self.timeout = timeout
+        self.prompt_cache = PromptCache()
+        cache_dir = os.path.dirname(os.path.abspath(data_dir))
+        if response_cache is True:
+            response_cache = ResponseCache(os.path.join(cache_dir, "response_cache.db"))
+        self.response_cache = response_cache or None
+        if ledger is True:
+            ledger = CostLedger(os.path.join(cache_dir, "cost_ledger.db"))
+        self.ledger = ledger or None
+        self.daily_budget = daily_budget
+        self.scheduler = scheduler or default_scheduler()
+        self.backend = backend or get_backend()
+        self.prompt_budget = prompt_budget
+        self.reuse_threshold = reuse_threshold
+        self.lock = threading.RLock()
         self.data_dir = data_dir
         self.data_obj = QueryData(self.data_dir)
         self.job_data = self.data_obj.data
         self.config_path = config_path
+        self.configs = get_store(config_path)
+        self.config_name = config_name
         self.config, self.key, self.config_idx = self.load_config(config_name)
-        self.mlog = logger
     
+    def is_stale(self) -> bool:
+        """
+        True when the job database or the config file changed on disk since this maker last read
+        or wrote them.
+        """
+        return self.data_obj.is_stale() or file_stamp(self.config_path) != self.config_stamp
+
+    def reload(self):
+        """
+        Pick up changes to the job database and config file made outside of this maker.
+        """
+        with self.lock:
+            if self.data_obj.is_stale():
+                self.mlog.info(f"{self.data_dir} changed on disk, reloading")
+                self.data_obj.reload()
+            if file_stamp(self.config_path) != self.config_stamp:
+                self.mlog.info(f"{self.config_path} changed on disk, reloading")
+                self.config, self.key, self.config_idx = self.load_config(self.config_name)
+
     def __repr__(self):
         lines = ""
 
@@ -222,129 +520,157 @@ class LetterMaker:
 
     def load_config(self, config_name:Union[str, None]):
         """
-        Load the config into memory. Use config index 0 if the index is not passed as
-        an argument, or the passed index is out of bounds for the config list.
+        Load the config into memory. Use the first config if config_name is None or there is no
+        config by that name.
         """
-        config_idx = 0 # set default config index
-
-        with open(self.config_path, 'r') as confile:
-            config_file = json.load(confile)
+        config, config_idx = self.configs.lookup(config_name)
+        self.config_stamp = self.configs.stamp
+        return config, self.configs.key, config_idx
 
-        if config_name:
-            for idx, config in enumerate(config_file['configs']):
-                if config_name == config['name']:
-                    config_idx = idx
-                    break
-                else:
-                    print(f"no config with name {config_name} found")
-                    config_idx = 0
-
-        try:
-            config = config_file['configs'][config_idx]
-        except IndexError:
-            config = config_file['configs'][0]
-            self.mlog.info("You past an invalid configuration id. Changing id value to 0.")
-            self.mlog.warn(f"Configuration has {len(config_file)} entries. You attempted to get entry {config_idx}")
-        # config.update({'key': config_file['key']})
-        return config, config_file['key'], config_idx
+    def config_for(self, config_name:Union[str, None]=None) -> dict:
+        """
+        The config to use for one request: the maker's own config when config_name is None or
+        names it, otherwise the named config from the store. Raises KeyError for an unknown name.
+        """
+        if config_name is None or config_name == self.config.get('name'):
+            return self.config
+        return self.configs.get(config_name)
 
     def save_config(self, name:str):
-        with open(self.config_path, 'r') as file:
-            config_file = json.load(file)
-        configs = config_file['configs'] 
-        config_names = [x['name'] for x in configs]
         self.mlog.info(f"Saving new config under the name '{name}'...")
 
+        self.prompt_cache.invalidate(self.config.get('name'))
         self.config['name'] = name
 
-        if self.config['name'] == any(config_names):
-            old_config = config_names.index(self.config['name'])
-            configs[old_config] = self.config
-        else:
-            configs.append(self.config)
-            
-        config_file['configs'] = configs
-        with open(self.config_path, 'w') as file:
-            json.dump(config_file, file, indent=4)
+        with self.lock:
+            self.config = self.configs.save(self.config)
+            self.config_stamp = self.configs.stamp
 
-        self.mlog.info("-- finished saving new config --")
-        print(f"Saved {name} config to {self.config_path}.")
+        self.mlog.info("Saved %s config version %s to %s", name, self.config['version'], self.config_path)
         return self.config
     
     def set_sysmsg(self, message=None):
         if not message:
-            print("You have to enter a system message to update it!")
+            self.mlog.warning("You have to enter a system message to update it!")
         else:
             self.config['system_message'] = message
-            print("System message updated!")
+            self.prompt_cache.invalidate(self.config.get('name'))
+            self.mlog.info("System message updated!")
     
     def set_instructions(self, instructions=None):
         if not instructions:
-            print("You have to enter a system message to update it!")
+            self.mlog.warning("You have to enter a system message to update it!")
         else:
             self.config['instructions'] = instructions
-            print("Instructions updated!")
+            self.prompt_cache.invalidate(self.config.get('name'))
+            self.mlog.info("Instructions updated!")
 
     def set_first_message(self, message):
         if not message:
-            print("You have to enter a message to update this config setting!")
+            self.mlog.warning("You have to enter a message to update this config setting!")
         else:
             self.config['first_message'] = message
-            print("First message updated!")
+            self.prompt_cache.invalidate(self.config.get('name'))
+            self.mlog.info("First message updated!")
 
     def set_personal_info(self, path:Union[str, None]=None):
         if not path:
-            print("Please pass the path to the .txt file containing your personal info to update the conifg.")
+            self.mlog.warning("Please pass the path to the .txt file containing your personal info to update the conifg.")
         else:
             self.config['pinfo'] = path
-            print("Personal Info Updated in the current configuration!")
+            self.prompt_cache.invalidate(self.config.get('name'))
+            self.mlog.info("Personal Info Updated in the current configuration!")
 
     def set_letter_template(self, path:Union[str, None]=None):
         if not path:
-            print("Please pass the path to the .txt file containing your letter template to update the conifg.")
+            self.mlog.warning("Please pass the path to the .txt file containing your letter template to update the conifg.")
         else:
             self.config['template'] = path
-            print("Letter Template Updated in the current configuration!")
+            self.prompt_cache.invalidate(self.config.get('name'))
+            self.mlog.info("Letter Template Updated in the current configuration!")
 
-    def _transaction_record(self, response, index):
+    def _transaction_record(self, response, index, config:Union[dict, None]=None):
         """
         Constructor for a record to update the data-base.
         """
-        cost = response['usage']['total_tokens'] * (.002 / 1000)
+        usage = response['usage']
+        cache_hit = bool(response.get('cached'))
+        cost = 0.0 if cache_hit else cost_for(response['model'], usage)
         update = {
                 "index": index,
-                "num_tokens" : response['usage']['total_tokens'],
+                "num_tokens" : usage['total_tokens'],
                 "response_model" : response['model'],
                 "response_text" : response['choices'][0]['message']['content'],
                 "response_timestamp": response['created'],
                 "response_cost": cost,
-                "response_generated": True
+                "response_generated": True,
+                "cache_hit": cache_hit,
+                "prompt_tokens": usage.get('prompt_tokens', 0),
+                "completion_tokens": usage.get('completion_tokens', 0),
+                "response_config": (config or self.config).get('name'),
                 }
+        budget = response.get('prompt_budget')
+        if budget:
+            update["prompt_tokens_before"] = budget['before']
+            update["prompt_tokens_after"] = budget['after']
         return update
 
     def _update_transaction_record(self, updates):
         """
-        Update the config file with token and cost estimates from the transaction.
+        Append the cost of the transaction to the ledger and send the updates through to the data
+        management object to record the responses into the json file.
+
+        Returns the totals of the transaction.
         """
-        tokens_spent = sum([item['num_tokens'] for item in updates if item['num_tokens']])
-        total_cost = tokens_spent * (.002 / 1000)
+        entries = []
+        for item in updates:
+            cache_hit = item.pop('cache_hit', False)
+            reused_from = item.pop('reused_from', None)
+            prompt_tokens = item.pop('prompt_tokens', 0)
+            completion_tokens = item.pop('completion_tokens', 0)
+            if item.get('response_generated'):
+                entries.append({
+                    "config": item.get('response_config') or self.config.get('name'),
+                    "model": item.get('response_model'),
+                    "job_index": item['index'],
+                    "prompt_tokens": 0 if cache_hit else prompt_tokens,
+                    "completion_tokens": 0 if cache_hit else completion_tokens,
+                    "cost": item.get('response_cost') or 0.0,
+                    "cached": cache_hit,
+                    "reused_from": reused_from,
+                    })
 
-        self.mlog.debug(f"tokens in transaction:     {tokens_spent}")
-        self.mlog.debug(f"cost of transaction:       {total_cost}")
+        cache_hits = sum(1 for entry in entries if entry['cached'])
+        reused = sum(1 for entry in entries if entry['reused_from'] is not None)
+        totals = {
+            "letters": len(entries),
+            "failed": len(updates) - len(entries),
+            "reused": reused,
+            "cache_hits": cache_hits,
+            "cache_misses": len(entries) - cache_hits - reused,
+            "tokens": sum(entry['prompt_tokens'] + entry['completion_tokens'] for entry in entries),
+            "cost": sum(entry['cost'] for entry in entries),
+            }
+        log_event(self.mlog, "transaction", **totals)
+        LETTERS.inc(totals['letters'] - reused, status="generated")
+        LETTERS.inc(reused, status="reused")
+        LETTERS.inc(totals['failed'], status="failed")
+        TOKENS.inc(sum(entry['prompt_tokens'] for entry in entries), kind="prompt")
+        TOKENS.inc(sum(entry['completion_tokens'] for entry in entries), kind="completion")
+        COST.inc(totals['cost'])
 
-        with open(self.config_path, "r") as cfile:
-            config_file = json.load(cfile)
-    
-        config_file['total_tokens'] += tokens_spent
-        config_file['current_cost'] += total_cost
-        with open(self.config_path, 'w') as cfile:
-            json.dump(config_file, cfile, indent=4)
+        if self.ledger is not None and entries:
+            self.ledger.record(entries)
+        self.data_obj.update_entries(updates)
+        return totals
+
+    def spend(self, by:str="day", since:Union[str, None]=None) -> list:
         """
-        Send the updates through to the data management object to record the responses into the 
-        json file.
+        Cost totals from the ledger grouped by day, config or model, see CostLedger.totals.
         """
-        self.data_obj.update_entries(updates) 
-        
+        if self.ledger is None:
+            return []
+        return self.ledger.totals(by=by, since=since)
 
     def find_job_data(self, new_only:bool=True, indexes:Union[list, None]=None):
         """
@@ -359,7 +685,137 @@ class LetterMaker:
 
         return job_data
     
-    def get_letter(self, job_data:list):
+    def letter_for(self, job:dict, config_name:Union[str, None]=None):
+        """
+        Generate a letter for a single posting. job is either {"index": n} for a posting that is
+        already in the database, or the posting's fields, which get added to the database first.
+
+        Returns the index of the posting and the response from get_letter.
+        """
+        index = self.resolve_job(job)
+        if index is None:
+            return None, {"response": f"No job found for {job}", "status": "404"}
+        return index, self.get_letter([self.job_data[index]], config_name=config_name)
+
+    def resolve_job(self, job:dict) -> Union[int, None]:
+        """
+        Find the database index for a job given as {"index": n} or as posting fields, adding the
+        posting to the database if it isn't there yet.
+        """
+        if 'company' not in job and 'index' in job:
+            index = job['index']
+        else:
+            entry = {k: v for k, v in job.items() if k != 'index'}
+            entry.setdefault('additional_info', "")
+            self.data_obj.add_entries([dict(entry)])
+            index = self.data_obj.lookup(entry)
+
+        if not isinstance(index, int) or not 0 <= index < len(self.job_data):
+            return None
+        return index
+
+    def stream_letter(self, job:dict, config_name:Union[str, None]=None, model:Union[str, None]=None):
+        """
+        Streaming version of get_letter for a single job. Yields the letter text piece by piece as
+        the model produces it, then records the assembled letter the same way get_letter does.
+        Errors from the API are raised to the caller once the retries run out.
+
+        The letter is recorded even when the stream stops early, because the caller went away or
+        the API failed part way, so what was written and billed still reaches the database and the
+        ledger. Only complete letters go to the response cache. BudgetExceeded is raised before
+        the query when it could take the spend over the maker's daily_budget.
+        """
+        from openai.openai_object import OpenAIObject
+        config = self.config_for(config_name)
+        model = self._model(config, model)
+        description = self._job_query(job)
+        messages, prompt_tokens, raw_tokens = self._messages(description, config)
+        budget = {"before": raw_tokens, "after": prompt_tokens}
+
+        key = None
+        if self.response_cache is not None and TEMPERATURE == 0:
+            key = cache_key(model, messages, temperature=TEMPERATURE)
+            cached = self.response_cache.get(key)
+            if cached is not None:
+                CACHE.inc(result="hit")
+                cached['cached'] = True
+                response = OpenAIObject.construct_from(cached)
+                response['prompt_budget'] = budget
+                self._update_transaction_record([self._transaction_record(response, job['index'], config)])
+                yield response['choices'][0]['message']['content']
+                return
+            CACHE.inc(result="miss")
+
+        guard = self._budget_guard(None, config)
+        if guard is not None and guard.reserve(self._job_estimate(job, config, model)) is None:
+            raise BudgetExceeded(f"a letter for index {job['index']} could go over the daily budget")
+
+        deadline = time.monotonic() + self.timeout if self.timeout else None
+        start = time.perf_counter()
+        chunks = self.scheduler.submit(self.backend.create, messages, model,
+                                       prompt_tokens=prompt_tokens,
+                                       api_key=self.key,
+                                       temperature=TEMPERATURE,
+                                       request_timeout=self.timeout,
+                                       deadline=deadline,
+                                       stream=True)
+        parts = []
+        created = None
+        finished = False
+        try:
+            for chunk in chunks:
+                model = chunk.get('model', model)
+                created = created or chunk.get('created')
+                delta = chunk['choices'][0].get('delta', {}).get('content')
+                if delta:
+                    parts.append(delta)
+                    yield delta
+            finished = True
+        finally:
+            # also runs when the caller closes the generator, the tokens are billed either way
+            API_LATENCY.observe(time.perf_counter() - start, status="ok" if finished else "error")
+            if not finished:
+                self.mlog.warning("stream for index %s stopped after %s pieces, recording what was written",
+                                  job['index'], len(parts))
+            text = "".join(parts)
+            if text:
+                completion_tokens = count_tokens(text, model)
+                response = OpenAIObject.construct_from({
+                    "model": model,
+                    "created": created or int(time.time()),
+                    "usage": {
+                        "prompt_tokens": prompt_tokens,
+                        "completion_tokens": completion_tokens,
+                        "total_tokens": prompt_tokens + completion_tokens,
+                        },
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": text}}],
+                    })
+                if finished and key is not None:
+                    self.response_cache.put(key, response)
+                response['prompt_budget'] = budget
+                record = self._transaction_record(response, job['index'], config)
+            else:
+                record = self._failed_record(job['index'])
+            self._update_transaction_record([record])
+
+    @staticmethod
+    def _model(config:dict, model:Union[str, None]=None) -> str:
+        """
+        The model for a query: the one asked for, else the config's model key, else MODEL.
+        """
+        return model or config.get('model') or MODEL
+
+    def _messages(self, description:str, config:Union[dict, None]=None):
+        config = config or self.config
+        budget = config.get('prompt_budget', self.prompt_budget)
+        return self.prompt_cache.messages(config, description, budget=budget)
+
+    def get_letter(self,
+                   job_data:list,
+                   max_workers:int=1,
+                   budget:Union[float, None]=None,
+                   config_name:Union[str, None]=None,
+                   reuse:Union[str, None]=None):
         """
         formats and retrieves cover letter queires from the OpenAI API and then updates the job_data
         JSON file to store the response.
@@ -368,80 +824,357 @@ class LetterMaker:
         are stored in the JSON record.
 
         Otherwise it returns the response from the single job.
-        """
-        import time
 
+        max_workers sets how many queries are allowed in flight at once. With the default of 1 the
+        jobs are processed one after the other, anything higher fans the jobs out over a thread pool
+        and the records are collected as they finish.
+
+        budget caps what this call may spend in USD. Along with the maker's daily_budget it stops
+        the batch before starting a job that could take the spend over either cap. The jobs that
+        did run are still recorded.
+
+        config_name picks another config from the config file for this call only, the maker's own
+        config is left as it is.
+
+        reuse="reuse" takes the letter of a near-duplicate posting for the same company instead of
+        querying the API, when the similarity index has one with a letter. reuse="adapt" also
+        takes letters written for other companies and swaps in this posting's company and title.
+        Reused letters cost nothing. They keep the model that wrote them and the ledger records the
+        posting they came from in reused_from, apart from cache hits.
+        """
         if len(job_data) > 1:
             multiple = True
         else:
             multiple = False
         update_list = []
         response = {}
-        for job in job_data:
-            self.mlog.debug(printf(f"starting query for:\ncompany: {job['company']}\nposition: {job['job_title']}"))
-            job_query = f"Company: {job['company']}\nPosition Title: {job['job_title']}\ndescription: {job['job_description']}"
-            response = self.query(job_query + job['additional_info'])
-            start = time.time()
-            sec = 1.0
-            while not isinstance(response, OpenAIObject):
-                if time.time() > start + sec:
-                    print(sec)
-                    print(f"current response: {type(response)}")
-                    sec += 1.0
-                
-            #self.mlog.debug(f"RESPONSE:\n{response}")
-            if isinstance(response, OpenAIObject):
-                update_list.append(self._transaction_record(response, job['index']))
-            else:
-                update_list.append({
-                                    "index": job['index'],
-                                    "response_text": "Request Failed",
-                                    "response_generated": False,
-                                    })
+        config = self.config_for(config_name)
+        if reuse:
+            remaining = []
+            for job in job_data:
+                record, response = self._reuse_record(job, reuse, config)
+                if record is None:
+                    remaining.append(job)
+                else:
+                    update_list.append(record)
+            if update_list:
+                self.mlog.info("reused %s letters from near-duplicate postings", len(update_list))
+            job_data = remaining
+        reused = len(update_list)
+        guard = self._budget_guard(budget, config)
+        if max_workers > 1 and multiple:
+            update_list += self._batch_query(job_data, max_workers, guard, [(config, None)])
+        else:
+            for job in job_data:
+                if guard is not None:
+                    reserved = guard.reserve(self._job_estimate(job, config))
+                    if reserved is None:
+                        response = {"response": "Budget cap reached, no letter was generated", "status": "402"}
+                        break
+                record, response = self._process_job(job, config)
+                if guard is not None:
+                    guard.settle(record.get('response_cost') or 0.0, reserved)
+                update_list.append(record)
 
+        total = len(job_data) + reused
+        skipped = total - len(update_list)
+        if skipped:
+            self.mlog.warning(f"budget cap reached, skipped {skipped} of {total} jobs")
         self._update_transaction_record(update_list)
 
         if multiple:
+            if skipped:
+                return {"response": f"Stopped at the budget cap after {len(update_list)} of {total} cover letters",
+                        "status": "402"}
             return {"response": "Successfully Created the cover letters"}
         return response
 
-    def query(self, description) -> dict: 
+    def get_variants(self,
+                     job_data:list,
+                     configs:Union[list, None]=None,
+                     models:Union[list, None]=None,
+                     max_workers:int=8,
+                     budget:Union[float, None]=None) -> dict:
+        """
+        Generate one letter per job for every combination of the config names in configs and the
+        models in models, all through one thread pool. configs defaults to the maker's config and
+        models to each config's own model. Every variant is stored with its config name in
+        response_config next to response_model, see JobFrame.compare_variants.
+
+        The prompt prefix of each config is built once and the job descriptions are tokenized once
+        per job, whatever the number of variants. budget works as in get_letter.
 
-        self.mlog.info(printf(f"starting query for:{description}"))
+        Returns the totals of the run from _update_transaction_record.
+        """
+        config_list = [self.config_for(name) for name in (configs or [None])]
+        variants = [(config, model) for config in config_list for model in (models or [None])]
+        guard = self._budget_guard(budget, config_list[0],
+                                   [self._model(config, model) for config, model in variants])
+        self.mlog.info("generating %s variants for %s jobs", len(variants), len(job_data))
+        update_list = self._batch_query(job_data, max(1, max_workers), guard, variants)
+        skipped = len(job_data) * len(variants) - len(update_list)
+        if skipped:
+            self.mlog.warning(f"budget cap reached, skipped {skipped} of {len(job_data) * len(variants)} variants")
+        totals = self._update_transaction_record(update_list)
+        totals['variants'] = len(variants)
+        totals['skipped'] = skipped
+        return totals
 
+    def _budget_guard(self,
+                      budget:Union[float, None],
+                      config:Union[dict, None]=None,
+                      models:Union[list, None]=None) -> Union[BudgetGuard, None]:
+        limits = []
+        if budget is not None:
+            limits.append(budget)
+        if self.daily_budget is not None and self.ledger is not None:
+            limits.append(self.daily_budget - self.ledger.spent_today())
+        if not limits:
+            return None
+        config = config or self.config
+        prompt_tokens = config.get('prompt_budget', self.prompt_budget) or 4096
+        worst_case = max(estimate_cost(model, prompt_tokens, self.scheduler.completion_tokens)
+                         for model in (models or [self._model(config)]))
+        return BudgetGuard(min(limits), worst_case)
+
+    def _job_estimate(self, job:dict, config:Union[dict, None]=None, model:Union[str, None]=None) -> float:
+        """
+        What a letter for job should cost at most: its counted prompt tokens plus the scheduler's
+        completion estimate. The prompt is built through the prompt cache, so the query that
+        follows doesn't count it again.
+        """
+        config = config or self.config
         try:
-            with open(self.config['pinfo'], "r") as pinfo_file:
-                pinfo = pinfo_file.read()
+            _, prompt_tokens, _ = self._messages(self._job_query(job), config)
         except FileNotFoundError:
-            msg = f"Personal Info File Error:\nNo file found for: {self.config['pinfo']}"
-            self.mlog.info(printf(msg))
-            return {"response": msg, "status": "404"}
+            prompt_tokens = config.get('prompt_budget', self.prompt_budget) or 4096
+        return estimate_cost(self._model(config, model), prompt_tokens, self.scheduler.completion_tokens)
+
+    def _batch_query(self,
+                     job_data:list,
+                     max_workers:int,
+                     guard:Union[BudgetGuard, None]=None,
+                     variants:Union[list, None]=None):
+        """
+        Run _process_job over a thread pool with at most max_workers queries in flight and return
+        the transaction records in the order they completed. Jobs are only handed to the pool once
+        the budget guard allows them.
+
+        variants is a list of (config, model) pairs, each job is run once per pair. The default is
+        the maker's config and model.
+        """
+        from collections import deque
+        from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
+        update_list = []
+        queue = deque((job, config, model) for job in job_data for config, model in (variants or [(None, None)]))
+        futures = {}
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            def fill():
+                while queue and len(futures) < max_workers:
+                    job, config, model = queue[0]
+                    reserved = None
+                    if guard is not None:
+                        reserved = guard.reserve(self._job_estimate(job, config, model))
+                        if reserved is None:
+                            return
+                    queue.popleft()
+                    futures[pool.submit(self._process_job, job, config, model)] = (job, reserved)
+
+            fill()
+            while futures:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    job, reserved = futures.pop(future)
+                    try:
+                        record, _ = future.result()
+                    except Exception as err:
+                        self.mlog.exception(f"query for index {job['index']} raised:\n{err}")
+                        record = self._failed_record(job['index'])
+                    if guard is not None:
+                        guard.settle(record.get('response_cost') or 0.0, reserved)
+                    update_list.append(record)
+                fill()
+        self.mlog.info(f"batch finished {len(update_list)} queries for {len(job_data)} jobs")
+        return update_list
+
+    def _process_job(self, job:dict, config:Union[dict, None]=None, model:Union[str, None]=None):
+        """
+        Query the API for a single job and build its transaction record. Returns the record and the
+        raw response.
+        """
+        self.mlog.debug("starting query for index %s: %s - %s", job['index'], job['company'], job['job_title'])
+        deadline = time.monotonic() + self.timeout if self.timeout else None
+        handle = self.submit_query(self._job_query(job), config, model, deadline)
         try:
-            with open(self.config['template'], "r") as template_file:
-                template = template_file.read()
-        except FileNotFoundError:
-            msg = f"Personal Info File Error:\nNo file found for: {self.config['template']}"
-            self.mlog.info(printf(msg))
+            response = handle.wait(self.timeout)
+        except ResponseTimeout as err:
+            self.mlog.warning(f"query for index {job['index']} timed out: {err}")
+            response = {"response": str(err), "status": "408"}
+            handle.add_done_callback(lambda late: self._orphaned(late, job['index'], config))
+
+        #self.mlog.debug(f"RESPONSE:\n{response}")
+        from openai.openai_object import OpenAIObject
+        if isinstance(response, OpenAIObject):
+            return self._transaction_record(response, job['index'], config), response
+        return self._failed_record(job['index']), response
+
+    @staticmethod
+    def _job_query(job:dict) -> str:
+        job_query = f"Company: {job['company']}\nPosition Title: {job['job_title']}\ndescription: {job['job_description']}"
+        return job_query + job['additional_info']
+
+    def _failed_record(self, index):
+        return {
+                "index": index,
+                "response_text": "Request Failed",
+                "response_generated": False,
+                }
+
+    def _reuse_record(self, job:dict, mode:str, config:dict):
+        """
+        Build a record for job from the letter of its closest near-duplicate that has one. mode is
+        "reuse", which only takes letters written for the same company, or "adapt", which also
+        takes other companies' letters and swaps in this job's company and title. Returns
+        (None, {}) when there is nothing to reuse.
+        """
+        for source_index, score in self.data_obj.near_duplicates(job, threshold=self.reuse_threshold):
+            source = self.job_data[source_index]
+            texts = source.get('response_text') or []
+            letters = [(text, model) for text, model in zip(texts, source.get('response_model') or [None] * len(texts))
+                       if text and text != "Request Failed"]
+            if not letters:
+                continue
+            text, model = letters[-1]
+            if normalize(source.get('company')) != normalize(job.get('company')):
+                if mode != "adapt":
+                    continue
+                text = self._adapt_letter(text, source, job)
+            self.mlog.info("index %s reuses the letter of index %s (similarity %.2f)", job['index'], source_index, score)
+            record = {
+                    "index": job['index'],
+                    "num_tokens": 0,
+                    "response_model": model,
+                    "response_text": text,
+                    "response_timestamp": int(time.time()),
+                    "response_cost": 0.0,
+                    "response_generated": True,
+                    "reused_from": source_index,
+                    "response_config": config.get('name'),
+                    }
+            response = {"choices": [{"message": {"content": text}}], "model": model, "reused_from": source_index}
+            return record, response
+        return None, {}
+
+    @staticmethod
+    def _adapt_letter(text:str, source:dict, job:dict) -> str:
+        """
+        Swap the source posting's company and job title in text for job's.
+        """
+        for field in ('company', 'job_title'):
+            old, new = (source.get(field) or "").strip(), (job.get(field) or "").strip()
+            if old and new and normalize(old) != normalize(new):
+                text = re.sub(re.escape(old), lambda _: new, text, flags=re.IGNORECASE)
+        return text
+
+    def _orphaned(self, handle:RequestHandle, index:int, config:Union[dict, None]=None):
+        """
+        Account for a query that finished after its job was given up on. The letter is not stored,
+        the job is already recorded as failed, but what it cost goes to the metrics and the ledger.
+        """
+        from openai.openai_object import OpenAIObject
+        try:
+            response = handle.wait(0)
+        except Exception:
+            return
+        if not isinstance(response, OpenAIObject) or response.get('cached'):
+            return
+        record = self._transaction_record(response, index, config)
+        ORPHANED.inc()
+        COST.inc(record['response_cost'])
+        TOKENS.inc(record['prompt_tokens'], kind="prompt")
+        TOKENS.inc(record['completion_tokens'], kind="completion")
+        self.mlog.warning("a response for index %s arrived after it timed out, $%.4f spent on it",
+                          index, record['response_cost'])
+        if self.ledger is not None:
+            self.ledger.record([{
+                "config": record['response_config'],
+                "model": record['response_model'],
+                "job_index": index,
+                "prompt_tokens": record['prompt_tokens'],
+                "completion_tokens": record['completion_tokens'],
+                "cost": record['response_cost'],
+                "cached": False,
+                }])
+
+    def submit_query(self,
+                     description,
+                     config:Union[dict, None]=None,
+                     model:Union[str, None]=None,
+                     deadline:Union[float, None]=None) -> RequestHandle:
+        """
+        Start a query in the background and return its handle.
+        """
+        return RequestHandle.run(self.query, description, config, model, deadline)
+
+    def query(self,
+              description,
+              config:Union[dict, None]=None,
+              model:Union[str, None]=None,
+              deadline:Union[float, None]=None) -> dict:
+        """
+        deadline is the time.monotonic() time after which the caller stops waiting, retries stop
+        there rather than running on in the background, see RequestScheduler.submit.
+        """
+        # openai is imported on the first query rather than with the module, it takes a while to load
+        import openai
+        from openai.openai_object import OpenAIObject
+
+        config = config or self.config
+        model = self._model(config, model)
+        try:
+            messages, prompt_tokens, raw_tokens = self._messages(description, config)
+        except FileNotFoundError as err:
+            msg = f"Prompt File Error:\nNo file found for: {err.filename}"
+            self.mlog.warning(msg)
             return {"response": msg, "status": "404"}
 
-        MODEL = "gpt-3.5-turbo"
-        openai.api_key = self.key
-        response = openai.ChatCompletion.create(
-            model=MODEL,
-            messages=[
-                {"role": "system", "content": self.config['system_message']},
-                {"role": "user", "content": self.config['instructions']},
-                {"role": "assistant", "content": self.config['first_message']},
-                {"role": "user", "content": "Here is my info: " + pinfo},
-                {"role": "assistant", "content": "Great! What job are you applying for?"},
-                {"role": "user", "content": "This is the job listing: " + description},
-                {"role": "assistant", "content": "Great! What letter template should use?"},
-                {"role": "user", "content": "Here it is: " + template},
-            ],
-            temperature=0,
-        )
-        self.mlog.info(printf(f"received response:\n{response}"))
+        key = None
+        if self.response_cache is not None and TEMPERATURE == 0:
+            key = cache_key(model, messages, temperature=TEMPERATURE)
+            cached = self.response_cache.get(key)
+            if cached is not None:
+                CACHE.inc(result="hit")
+                log_event(self.mlog, "query.cache_hit", key=key[:12])
+                cached['cached'] = True
+                cached['prompt_budget'] = {"before": raw_tokens, "after": prompt_tokens}
+                return OpenAIObject.construct_from(cached)
+            CACHE.inc(result="miss")
+
+        start = time.perf_counter()
+        try:
+            response = self.scheduler.submit(self.backend.create, messages, model,
+                                             prompt_tokens=prompt_tokens,
+                                             api_key=self.key,
+                                             temperature=TEMPERATURE,
+                                             request_timeout=self.timeout,
+                                             deadline=deadline)
+        except ResponseTimeout as err:
+            API_LATENCY.observe(time.perf_counter() - start, status="timeout")
+            self.mlog.warning(f"query ran out of time: {err}")
+            return {"response": str(err), "status": "408"}
+        except openai.error.OpenAIError as err:
+            API_LATENCY.observe(time.perf_counter() - start, status="error")
+            msg = f"OpenAI request failed after retries:\n{err}"
+            self.mlog.error(msg)
+            return {"response": msg, "status": str(getattr(err, 'http_status', None) or 500)}
+        latency = time.perf_counter() - start
+        API_LATENCY.observe(latency, status="ok")
+        log_event(self.mlog, "query.done", model=response.get('model'), latency=round(latency, 3),
+                  usage=response.get('usage'), prompt_tokens_before=raw_tokens)
+        if key is not None:
+            self.response_cache.put(key, response)
+        response['prompt_budget'] = {"before": raw_tokens, "after": prompt_tokens}
         return response
 
 class OpenAIObject_Fake:
@@ -454,19 +1187,26 @@ class OpenAIObject_Fake:
             response = json.load(fake)
         return response
 
-class TimedResponse:
+class TimedResponse(RequestHandle):
+    """
+    Fake request handle that resolves to an OpenAIObject_Fake after duration seconds.
+    """
     def __init__(self, duration:int=10):
-        import time
+        super().__init__()
         self.start = time.time()
         self.duration = duration
         self.mlog = logger
+        self._timer = threading.Timer(duration, self._resolve)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _resolve(self):
+        self.mlog.debug("%s:\nresponse: %s", self.duration, type(self))
+        try:
+            self.set_result(OpenAIObject_Fake())
+        except Exception as err:
+            self.set_exception(err)
 
-    def timer(self):
-        import time
-        t_plus = 1
-        while time.time() < self.start + self.duration:
-            if time.time() >= self.start + t_plus:
-                self.mlog.debug(f"{t_plus}:\nresponse: {type(self)}")
-                t_plus += 1
-        return OpenAIObject_Fake()
+    def timer(self, timeout:Union[float, None]=None):
+        return self.wait(timeout)
 
@@ -0,0 +1,139 @@
+from functools import lru_cache
+from typing import TYPE_CHECKING, Iterable, Union
+from .records import as_dict
+
+if TYPE_CHECKING:
+    import polars as pl
+
+
+@lru_cache(maxsize=None)
+def columns() -> dict:
+    """
+    The dtype of every column. polars is imported here and in the JobFrame methods rather than at
+    the top of the module, so the frame costs nothing until something actually asks for it.
+
+    job_description is left out, no view uses it and it would pull every posting back into memory.
+    """
+    import polars as pl
+    return {
+        "index": pl.Int64,
+        "company": pl.Utf8,
+        "job_title": pl.Utf8,
+        "additional_info": pl.Utf8,
+        "num_tokens": pl.Int64,
+        "response_generated": pl.Boolean,
+        "response_count": pl.Int64,
+        "response_text": pl.List(pl.Utf8),
+        "response_model": pl.List(pl.Utf8),
+        "response_timestamp": pl.List(pl.Int64),
+        "response_cost": pl.List(pl.Float64),
+        "response_config": pl.List(pl.Utf8),
+        "total_cost": pl.Float64,
+        "prompt_tokens_before": pl.Int64,
+        "prompt_tokens_after": pl.Int64,
+        }
+RESPONSE_COLUMNS = ["response_text", "response_model", "response_timestamp", "response_cost", "response_config"]
+
+
+class JobFrame:
+    """
+    Columnar view over the records of a QueryData object.
+
+    The DataFrame is built the first time it is asked for. After that, invalidate() marks records
+    as stale, and only those rows are rebuilt and swapped in on the next access.
+    """
+    def __init__(self, records:list):
+        self.records = records
+        self._frame = None
+        self._dirty = set()
+
+    def _build(self, rows:list) -> "pl.DataFrame":
+        import polars as pl
+        schema = columns()
+        data = {col: [] for col in schema}
+        for row in rows:
+            # one read per record, its lazy fields come off disk together
+            row = as_dict(row)
+            count = len(row.get('response_text') or [])
+            for col in schema:
+                data[col].append(row.get(col))
+            # records written before a response column existed get nulls so the lists stay aligned
+            for col in RESPONSE_COLUMNS:
+                if data[col][-1] is None:
+                    data[col][-1] = [None] * count
+        return pl.DataFrame(data, schema=schema)
+
+    def invalidate(self, indexes:Union[Iterable[int], None]=None):
+        """
+        Mark the records at indexes as stale, or drop the whole frame when indexes is None.
+        """
+        if indexes is None:
+            self._frame = None
+            self._dirty.clear()
+        elif self._frame is not None:
+            self._dirty.update(indexes)
+
+    def frame(self) -> "pl.DataFrame":
+        if self._frame is None:
+            self._frame = self._build(self.records)
+            self._dirty.clear()
+        elif self._dirty:
+            import polars as pl
+            dirty = sorted(self._dirty)
+            self._dirty.clear()
+            fresh = self._build([self.records[idx] for idx in dirty if idx < len(self.records)])
+            self._frame = pl.concat([
+                self._frame.filter(~pl.col("index").is_in(dirty)),
+                fresh,
+                ]).sort("index")
+        return self._frame
+
+    def lazy(self) -> "pl.LazyFrame":
+        return self.frame().lazy()
+
+    def responses(self) -> "pl.LazyFrame":
+        """
+        One row per generated response, with the list valued response fields exploded.
+        """
+        import polars as pl
+        return (self.lazy()
+                .select(["index", "company", "job_title"] + RESPONSE_COLUMNS)
+                .filter(pl.col("response_text").arr.lengths() > 0)
+                .explode(RESPONSE_COLUMNS))
+
+    def spend_by_model(self) -> "pl.DataFrame":
+        import polars as pl
+        return (self.responses()
+                .groupby("response_model")
+                .agg([pl.count().alias("letters"), pl.col("response_cost").sum().alias("cost")])
+                .sort("cost", descending=True)
+                .collect())
+
+    def compare_variants(self) -> "pl.DataFrame":
+        """
+        Letters, mean cost and mean length per config and model, for comparing the variants of a
+        get_variants run.
+        """
+        import polars as pl
+        return (self.responses()
+                .groupby(["response_config", "response_model"])
+                .agg([pl.count().alias("letters"),
+                      pl.col("response_cost").mean().alias("mean_cost"),
+                      pl.col("response_text").str.lengths().mean().alias("mean_chars")])
+                .sort(["response_config", "response_model"])
+                .collect())
+
+    def letters_by_company(self) -> "pl.DataFrame":
+        import polars as pl
+        return (self.responses()
+                .groupby("company")
+                .agg([pl.count().alias("letters"), pl.col("response_cost").sum().alias("cost")])
+                .sort("letters", descending=True)
+                .collect())
+
+    def missing_responses(self) -> "pl.DataFrame":
+        import polars as pl
+        return (self.lazy()
+                .filter(~pl.col("response_generated"))
+                .select(["index", "company", "job_title"])
+                .collect())
@@ -0,0 +1,133 @@
+import os
+import random
+import threading
+import time
+from typing import TYPE_CHECKING, Union
+from .handles import RequestHandle
+from .tokens import count_message_tokens
+
+if TYPE_CHECKING:
+    from openai.openai_object import OpenAIObject
+
+
+class CompletionBackend:
+    """
+    Something that answers chat completion requests. create() takes the same keyword arguments as
+    openai.ChatCompletion.create and returns an OpenAIObject, submit() does the same in the
+    background and returns a RequestHandle.
+
+    openai is imported where it is used so that choosing a backend stays cheap.
+    """
+    def create(self, **params) -> "OpenAIObject":
+        raise NotImplementedError
+
+    def submit(self, **params) -> RequestHandle:
+        return RequestHandle.run(self.create, **params)
+
+
+class OpenAIBackend(CompletionBackend):
+    def create(self, **params) -> "OpenAIObject":
+        import openai
+        return openai.ChatCompletion.create(**params)
+
+
+class MockBackend(CompletionBackend):
+    """
+    Offline stand-in for the API. Each call sleeps for a normally distributed latency, fails with
+    probability error_rate (as a 429 or a 503, which the scheduler retries), and otherwise returns
+    a response with completion_tokens words of text and a matching usage block.
+
+    With stream=True the latency is spent before the first chunk and the words are then yielded
+    one chunk at a time, token_interval seconds apart.
+    """
+    def __init__(self,
+                 latency:float=0.5,
+                 jitter:float=0.1,
+                 error_rate:float=0.0,
+                 completion_tokens:int=350,
+                 seed:Union[int, None]=None,
+                 token_interval:float=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.completion_tokens = completion_tokens
+        self.token_interval = token_interval
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = 0
+
+    def create(self,
+               model:str="gpt-3.5-turbo",
+               messages:Union[list, None]=None,
+               stream:bool=False,
+               **params) -> "OpenAIObject":
+        import openai
+        from openai.openai_object import OpenAIObject
+        with self.lock:
+            self.calls += 1
+            delay = max(0.0, self.random.gauss(self.latency, self.jitter))
+            fail = self.random.random() < self.error_rate
+            status = self.random.choice([429, 503])
+        time.sleep(delay)
+        if fail:
+            if status == 429:
+                raise openai.error.RateLimitError(message="mock rate limit", http_status=429)
+            raise openai.error.ServiceUnavailableError(message="mock server error", http_status=503)
+
+        if stream:
+            return self._stream(model)
+
+        prompt_tokens = count_message_tokens(messages or [], model)
+        return OpenAIObject.construct_from({
+            "id": f"mock-{self.calls}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": self.completion_tokens,
+                "total_tokens": prompt_tokens + self.completion_tokens,
+                },
+            "choices": [{
+                "index": 0,
+                "finish_reason": "stop",
+                "message": {"role": "assistant", "content": " ".join(["Lorem"] * self.completion_tokens)},
+                }],
+            })
+
+
+    def _stream(self, model:str):
+        from openai.openai_object import OpenAIObject
+        created = int(time.time())
+        for n in range(self.completion_tokens):
+            if n and self.token_interval:
+                time.sleep(self.token_interval)
+            yield OpenAIObject.construct_from({
+                "id": f"mock-{self.calls}",
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "delta": {"content": "Lorem" if n == 0 else " Lorem"}, "finish_reason": None}],
+                })
+        yield OpenAIObject.construct_from({
+            "id": f"mock-{self.calls}",
+            "object": "chat.completion.chunk",
+            "created": created,
+            "model": model,
+            "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+            })
+
+
+def get_backend(name:Union[str, None]=None) -> CompletionBackend:
+    """
+    Backend by name, defaulting to the AIPG_BACKEND environment variable and then to "openai".
+    The mock backend reads its latency and error rate from AIPG_MOCK_LATENCY and
+    AIPG_MOCK_ERROR_RATE.
+    """
+    name = name or os.environ.get("AIPG_BACKEND", "openai")
+    if name == "mock":
+        return MockBackend(latency=float(os.environ.get("AIPG_MOCK_LATENCY", 0.5)),
+                           error_rate=float(os.environ.get("AIPG_MOCK_ERROR_RATE", 0.0)))
+    if name == "openai":
+        return OpenAIBackend()
+    raise ValueError(f"Unknown completion backend: {name}")
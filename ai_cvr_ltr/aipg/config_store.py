@@ -0,0 +1,121 @@
+import os
+import threading
+import time
+from typing import Union
+from .logger import logger
+from .storage import VersionConflict, file_stamp, read_json, update_json
+
+
+class ConfigStore:
+    """
+    The named prompt configs in a config.json, indexed by name.
+
+    The file is parsed once and again only when its (mtime, size) stamp changes, so lookups are a
+    stat call and a dict access. Use get_store() to share one store per file across every maker in
+    the process. Each save bumps the version of the config it writes.
+    """
+    def __init__(self, path:Union[str, os.PathLike]):
+        self.path = path
+        self.mlog = logger
+        self.lock = threading.RLock()
+        self.stamp = None
+        self._file = None
+        self._index = {}
+
+    def _load(self, data:dict, stamp):
+        self._file = data
+        self.stamp = stamp
+        # later entries win, older files can hold duplicates of a name
+        self._index = {config['name']: idx for idx, config in enumerate(data['configs'])}
+
+    def refresh(self):
+        """
+        Re-read the file if it changed since the last read or save.
+        """
+        with self.lock:
+            if self._file is None or file_stamp(self.path) != self.stamp:
+                self._load(*read_json(self.path))
+
+    @property
+    def key(self) -> str:
+        self.refresh()
+        return self._file['key']
+
+    def names(self) -> list:
+        self.refresh()
+        return list(self._index)
+
+    def __contains__(self, name:str) -> bool:
+        self.refresh()
+        return name in self._index
+
+    def get(self, name:str) -> dict:
+        """
+        A copy of the config called name. Raises KeyError if there is none.
+        """
+        self.refresh()
+        with self.lock:
+            return dict(self._file['configs'][self._index[name]])
+
+    def lookup(self, name:Union[str, None]) -> tuple:
+        """
+        The config called name and its position in the file, falling back to the first config
+        when name is None or unknown.
+        """
+        self.refresh()
+        with self.lock:
+            idx = self._index.get(name)
+            if idx is None:
+                if name:
+                    self.mlog.warning("no config with name %s found, using %s", name, self._file['configs'][0]['name'])
+                idx = 0
+            return dict(self._file['configs'][idx]), idx
+
+    def version(self, name:str) -> int:
+        return self.get(name).get('version', 0)
+
+    def save(self, config:dict, expected_version:Union[int, None]=None) -> dict:
+        """
+        Insert config, or replace the config with the same name, and return what was written.
+        The read-modify-write holds the file lock, so saves from other processes aren't lost.
+
+        expected_version is the version the edit started from. If the stored config has moved on
+        since, someone else saved it in the meantime and VersionConflict is raised instead of
+        overwriting their change.
+        """
+        saved = dict(config)
+
+        def upsert(config_file):
+            configs = [entry for entry in config_file['configs'] if entry['name'] != saved['name']]
+            previous = [entry for entry in config_file['configs'] if entry['name'] == saved['name']]
+            current = max([entry.get('version', 0) for entry in previous], default=0)
+            if previous and expected_version is not None and current != expected_version:
+                raise VersionConflict(f"config {saved['name']} is at version {current}, "
+                                      f"the edit was made to version {expected_version}")
+            saved['version'] = current + 1
+            saved['updated'] = time.time()
+            if previous:
+                # keep the config where its first copy was, dropping any duplicates after it
+                configs.insert(config_file['configs'].index(previous[0]), saved)
+            else:
+                configs.append(saved)
+            config_file['configs'] = configs
+
+        with self.lock:
+            self._load(*update_json(self.path, upsert))
+        return dict(saved)
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+def get_store(path:Union[str, os.PathLike]) -> ConfigStore:
+    """
+    The process-wide ConfigStore for path.
+    """
+    key = os.path.abspath(path)
+    with _stores_lock:
+        store = _stores.get(key)
+        if store is None:
+            store = _stores[key] = ConfigStore(path)
+        return store
@@ -1,50 +1,96 @@
 import csv
 import json
-import logging
 import os
 import pprint as pp
-import tiktoken
+import time
+from .logger import logger
+from .storage import update_json
+from .tokens import count_tokens
 pp.PrettyPrinter(indent=4, depth=5, width=100)
 
 
 
-
-encoding = tiktoken.encoding_for_model("gpt-3.5-turbo")
-logging.basicConfig(level=logging.INFO)
-
 def make_config(config_path, personal_info, template):
 
-    with open(config_path, "r") as file:
-        config = json.load(file)
-
     p_info = os.path.abspath(personal_info)
     ltr_template = os.path.abspath(template)
 
-    config['configs'][0]['pinfo'] = p_info
-    config['configs'][0]['template'] = ltr_template
-    tokens = []
-    for k, v in config['configs'][0].items():
-        if isinstance(v, str):
-            # logging.debug(f"(k, tokens(v)):\n{(k, len(encoding.encode(v)))}")
-            tokens.append(len(encoding.encode(v)))
-        else:
-            continue
-    # logging.info(f"tokens: {tokens}")
-    config['configs'][0]['token_count'] = sum(tokens) 
-    with open(config_path, "w") as cfile:
-        json.dump(config, cfile, indent=2)
+    def set_paths(config):
+        config['configs'][0]['pinfo'] = p_info
+        config['configs'][0]['template'] = ltr_template
+        tokens = []
+        for k, v in config['configs'][0].items():
+            if isinstance(v, str):
+                # logger.debug(f"(k, tokens(v)):\n{(k, count_tokens(v))}")
+                tokens.append(count_tokens(v))
+            else:
+                continue
+        # logger.info(f"tokens: {tokens}")
+        config['configs'][0]['token_count'] = sum(tokens) 
+
+    update_json(config_path, set_paths, indent=2)
      
 def conv_csv(file_path):
+    return [normalize_row(row) for row in iter_csv(file_path)]
+
+def normalize_row(row:dict) -> dict:
+    """
+    Strip whitespace from the keys and string values of a scraped row and make sure it has an
+    additional_info field.
+    """
+    row = {k.strip(): v.strip() if isinstance(v, str) else v for k, v in row.items() if k}
+    row.setdefault("additional_info", "")
+    return row
+
+def iter_csv(file_path, delimiter:str=','):
+    with open(file_path, 'r', newline='') as file:
+        yield from csv.DictReader(file, delimiter=delimiter)
+
+def iter_jsonl(file_path):
     with open(file_path, 'r') as file:
-        data = list(csv.DictReader(file, delimiter=','))
-    for row in data:
-        row["additional_info"] = ""
-    
-    for idx, row in enumerate(data):
-        for k, v in row.items():
-            data[idx][k] = v.strip()
-    return data        
-
-conv_csv("./data/job_info.csv")
-
-    
+        for line in file:
+            if line.strip():
+                yield json.loads(line)
+
+def iter_rows(file_path):
+    """
+    Stream the rows of a .csv or .jsonl file one dict at a time.
+    """
+    if str(file_path).endswith(".jsonl"):
+        return iter_jsonl(file_path)
+    return iter_csv(file_path)
+
+def chunked(rows, size:int):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def ingest(file_path, query_data, chunk_size:int=1000):
+    """
+    Stream a CSV or JSONL scrape into a QueryData object. Rows are normalized one at a time as they
+    are read and handed to QueryData.add_entries chunk_size rows at a time, which validates each
+    chunk and quarantines the bad rows. Only a single chunk of the file is ever held by the
+    pipeline.
+
+    Returns a summary with the row counts, elapsed time and rows/sec.
+    """
+    start = time.perf_counter()
+    stats = {"rows": 0, "inserted": 0, "rejected": 0}
+
+    for chunk in chunked(map(normalize_row, iter_rows(file_path)), chunk_size):
+        report = query_data.add_entries(chunk)
+        stats["rows"] += len(chunk)
+        stats["inserted"] += report["inserted"]
+        stats["rejected"] += report["quarantined"]
+        elapsed = time.perf_counter() - start
+        logger.info(f"ingested {stats['rows']} rows ({stats['rows'] / elapsed:.0f} rows/sec)")
+
+    elapsed = time.perf_counter() - start
+    stats["seconds"] = elapsed
+    stats["rows_per_sec"] = stats["rows"] / elapsed if elapsed else 0.0
+    return stats
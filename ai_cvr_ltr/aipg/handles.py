@@ -0,0 +1,63 @@
+import threading
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from typing import Callable, Union
+
+
+class ResponseTimeout(Exception):
+    pass
+
+
+class RequestHandle:
+    """
+    A completion that may still be in flight. Backends return one of these instead of the response
+    itself so callers can block on it with a deadline rather than polling.
+    """
+    def __init__(self):
+        self._future = Future()
+
+    @classmethod
+    def run(cls, fn:Callable, *args, **kwargs) -> "RequestHandle":
+        """
+        Start fn on a daemon thread and return a handle for its result.
+        """
+        handle = cls()
+
+        def target():
+            try:
+                handle.set_result(fn(*args, **kwargs))
+            except BaseException as err:
+                handle.set_exception(err)
+
+        threading.Thread(target=target, daemon=True).start()
+        return handle
+
+    @classmethod
+    def resolved(cls, response) -> "RequestHandle":
+        handle = cls()
+        handle.set_result(response)
+        return handle
+
+    def set_result(self, response):
+        self._future.set_result(response)
+
+    def set_exception(self, err:BaseException):
+        self._future.set_exception(err)
+
+    def done(self) -> bool:
+        return self._future.done()
+
+    def add_done_callback(self, fn:Callable):
+        """
+        Call fn(handle) once the response or error arrives, right away if it already has.
+        """
+        self._future.add_done_callback(lambda _: fn(self))
+
+    def wait(self, timeout:Union[float, None]=None):
+        """
+        Sleep until the response arrives and return it. Raises ResponseTimeout once timeout
+        seconds have passed, and re-raises whatever the backend raised.
+        """
+        try:
+            return self._future.result(timeout)
+        except FutureTimeout:
+            raise ResponseTimeout(f"no response after {timeout} seconds") from None
@@ -0,0 +1,215 @@
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Callable, Union
+from .logger import logger
+
+
+class JobQueue:
+    """
+    Persistent queue of letter generation jobs in a local SQLite file. A job moves from queued to
+    running to done or failed.
+
+    A claimed job is leased to the claiming process for lease seconds, and the process renews the
+    lease with heartbeat() while it works. Several processes can share the file, e.g. one per
+    web server worker, so only jobs whose lease ran out, because the process holding them died,
+    are put back in the queue. That happens on every claim.
+    """
+    def __init__(self, path:Union[str, os.PathLike]="./job_queue.db", lease:float=120.0):
+        self.path = path
+        self.lease = lease
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self.mlog = logger
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                result TEXT,
+                error TEXT,
+                created REAL NOT NULL,
+                updated REAL NOT NULL
+            )""")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created)")
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(jobs)")}
+        if "owner" not in columns:
+            self.conn.execute("ALTER TABLE jobs ADD COLUMN owner TEXT")
+
+    def submit(self, payload:dict) -> str:
+        job_id = str(uuid.uuid4())
+        now = time.time()
+        with self.lock:
+            self.conn.execute("INSERT INTO jobs (id, status, payload, created, updated) VALUES (?, 'queued', ?, ?, ?)",
+                              (job_id, json.dumps(payload), now, now))
+        return job_id
+
+    def _requeue_expired(self, now:float) -> int:
+        requeued = self.conn.execute(
+                "UPDATE jobs SET status = 'queued', owner = NULL, updated = ? WHERE status = 'running' AND updated < ?",
+                (now, now - self.lease)).rowcount
+        if requeued:
+            self.mlog.info(f"requeued {requeued} jobs whose lease expired in {self.path}")
+        return requeued
+
+    def claim(self) -> Union[tuple, None]:
+        """
+        Mark the oldest queued job as running under this process's lease and return (id, payload),
+        or None if the queue is empty. Running jobs whose lease expired are requeued first.
+        """
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                now = time.time()
+                self._requeue_expired(now)
+                row = self.conn.execute(
+                        "SELECT id, payload FROM jobs WHERE status = 'queued' ORDER BY created LIMIT 1").fetchone()
+                if row:
+                    self.conn.execute("UPDATE jobs SET status = 'running', owner = ?, updated = ? WHERE id = ?",
+                                      (self.owner, now, row[0]))
+                self.conn.execute("COMMIT")
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+        if row is None:
+            return None
+        return row[0], json.loads(row[1])
+
+    def heartbeat(self, job_ids:list):
+        """
+        Renew the lease on running jobs this process holds.
+        """
+        if not job_ids:
+            return
+        with self.lock:
+            self.conn.execute(
+                    f"UPDATE jobs SET updated = ? WHERE status = 'running' AND owner = ? "
+                    f"AND id IN ({', '.join('?' * len(job_ids))})",
+                    (time.time(), self.owner, *job_ids))
+
+    def complete(self, job_id:str, result:dict):
+        with self.lock:
+            self.conn.execute("UPDATE jobs SET status = 'done', result = ?, updated = ? WHERE id = ?",
+                              (json.dumps(result), time.time(), job_id))
+
+    def fail(self, job_id:str, error:str):
+        with self.lock:
+            self.conn.execute("UPDATE jobs SET status = 'failed', error = ?, updated = ? WHERE id = ?",
+                              (error, time.time(), job_id))
+
+    def get(self, job_id:str) -> Union[dict, None]:
+        with self.lock:
+            row = self.conn.execute(
+                    "SELECT id, status, payload, result, error, created, updated FROM jobs WHERE id = ?",
+                    (job_id,)).fetchone()
+        if row is None:
+            return None
+        return {
+            "id": row[0],
+            "status": row[1],
+            "payload": json.loads(row[2]),
+            "result": json.loads(row[3]) if row[3] else None,
+            "error": row[4],
+            "created": row[5],
+            "updated": row[6],
+            }
+
+    def depth(self) -> int:
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()[0]
+
+
+class JobWorkerPool:
+    """
+    Background threads that drain a JobQueue. get_maker is called for every job so the workers
+    always use the application's current LetterMaker. Results reach the job database through
+    LetterMaker.get_letter and QueryData.update_entries like any other letter.
+    """
+    def __init__(self,
+                 queue:JobQueue,
+                 get_maker:Callable,
+                 workers:int=2,
+                 poll_interval:float=5.0):
+        self.queue = queue
+        self.get_maker = get_maker
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.mlog = logger
+        self.wakeup = threading.Event()
+        self.stopping = threading.Event()
+        self.threads = []
+        self.active = set()
+        self.active_lock = threading.Lock()
+
+    def start(self):
+        for n in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f"letter-worker-{n}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        thread = threading.Thread(target=self._heartbeat, name="letter-heartbeat", daemon=True)
+        thread.start()
+        self.threads.append(thread)
+
+    def _heartbeat(self):
+        # renew well inside the lease so a slow letter is never taken for an abandoned one
+        while not self.stopping.wait(self.queue.lease / 4):
+            with self.active_lock:
+                job_ids = list(self.active)
+            try:
+                self.queue.heartbeat(job_ids)
+            except sqlite3.Error as err:
+                self.mlog.warning(f"could not renew the lease on {job_ids}: {err}")
+
+    def stop(self, timeout:Union[float, None]=None):
+        self.stopping.set()
+        self.wakeup.set()
+        for thread in self.threads:
+            thread.join(timeout)
+
+    def submit(self, payload:dict) -> str:
+        job_id = self.queue.submit(payload)
+        self.wakeup.set()
+        return job_id
+
+    def _run(self):
+        while not self.stopping.is_set():
+            claimed = self.queue.claim()
+            if claimed is None:
+                self.wakeup.wait(self.poll_interval)
+                self.wakeup.clear()
+                continue
+            with self.active_lock:
+                self.active.add(claimed[0])
+            try:
+                self._process(*claimed)
+            finally:
+                with self.active_lock:
+                    self.active.discard(claimed[0])
+
+    def _process(self, job_id:str, payload:dict):
+        self.mlog.info(f"worker picked up job {job_id}")
+        job = dict(payload)
+        config_name = job.pop('config', None)
+        try:
+            maker = self.get_maker()
+            index, response = maker.letter_for(job, config_name=config_name)
+        except Exception as err:
+            self.mlog.exception(f"job {job_id} raised:\n{err}")
+            self.queue.fail(job_id, str(err))
+            return
+
+        if response.get('choices'):
+            self.queue.complete(job_id, {
+                "index": index,
+                "response_text": response['choices'][0]['message']['content'],
+                "response_model": response['model'],
+                "cached": bool(response.get('cached')),
+                })
+        else:
+            self.queue.fail(job_id, str(response.get('response', "Request Failed")))
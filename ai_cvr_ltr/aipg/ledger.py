@@ -0,0 +1,140 @@
+import datetime
+import os
+import sqlite3
+import threading
+import time
+from typing import Union
+from .logger import logger
+
+GROUPS = {"day": "day", "config": "config", "model": "model"}
+
+
+class CostLedger:
+    """
+    Append-only record of every letter's token usage and cost, in a SQLite file next to the job
+    database. Rows are never updated, and the indexes on day, config and model keep the aggregate
+    queries cheap however long the history gets.
+
+    Several processes can write to one ledger, batch workers do. WAL mode lets them append while
+    others read, and a writer waits up to timeout seconds for another's write to finish.
+    """
+    def __init__(self, path:Union[str, os.PathLike]="./cost_ledger.db", timeout:float=30.0):
+        self.path = path
+        self.mlog = logger
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=timeout, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS ledger (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                ts REAL NOT NULL,
+                day TEXT NOT NULL,
+                config TEXT,
+                model TEXT,
+                job_index INTEGER,
+                prompt_tokens INTEGER NOT NULL DEFAULT 0,
+                completion_tokens INTEGER NOT NULL DEFAULT 0,
+                cost REAL NOT NULL DEFAULT 0,
+                cached INTEGER NOT NULL DEFAULT 0,
+                reused_from INTEGER
+            )""")
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(ledger)")}
+        if "reused_from" not in columns:
+            # ledgers written before reused letters were told apart from cache hits
+            try:
+                self.conn.execute("ALTER TABLE ledger ADD COLUMN reused_from INTEGER")
+            except sqlite3.OperationalError:
+                # another process added it first
+                pass
+        for column in GROUPS.values():
+            self.conn.execute(f"CREATE INDEX IF NOT EXISTS ledger_{column} ON ledger ({column}, cost)")
+        self.conn.commit()
+
+    def record(self, entries:list):
+        """
+        Append entries, each a dict with config, model, job_index, prompt_tokens, completion_tokens,
+        cost and cached. reused_from is the index of the posting a reused letter was taken from.
+        """
+        now = time.time()
+        day = datetime.date.today().isoformat()
+        rows = [(now, day, e.get('config'), e.get('model'), e.get('job_index'),
+                 e.get('prompt_tokens') or 0, e.get('completion_tokens') or 0,
+                 e.get('cost') or 0.0, int(bool(e.get('cached'))), e.get('reused_from'))
+                for e in entries]
+        with self.lock:
+            self.conn.executemany("""
+                INSERT INTO ledger (ts, day, config, model, job_index, prompt_tokens, completion_tokens, cost, cached,
+                                    reused_from)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""", rows)
+            self.conn.commit()
+
+    def totals(self, by:str="day", since:Union[str, None]=None) -> list:
+        """
+        Letters, cache hits, reused letters, tokens and cost grouped by day, config or model. since
+        is an ISO date that limits the rows counted.
+        """
+        column = GROUPS[by]
+        query = f"""
+            SELECT {column}, COUNT(*), SUM(cached), COUNT(reused_from), SUM(prompt_tokens), SUM(completion_tokens),
+                   SUM(cost)
+            FROM ledger {'WHERE day >= ?' if since else ''}
+            GROUP BY {column} ORDER BY {column}"""
+        with self.lock:
+            rows = self.conn.execute(query, (since,) if since else ()).fetchall()
+        return [{by: row[0], "letters": row[1], "cache_hits": row[2], "reused": row[3], "prompt_tokens": row[4],
+                 "completion_tokens": row[5], "cost": row[6]} for row in rows]
+
+    def total_cost(self, since:Union[str, None]=None) -> float:
+        with self.lock:
+            if since:
+                row = self.conn.execute("SELECT SUM(cost) FROM ledger WHERE day >= ?", (since,)).fetchone()
+            else:
+                row = self.conn.execute("SELECT SUM(cost) FROM ledger").fetchone()
+        return row[0] or 0.0
+
+    def spent_today(self) -> float:
+        return self.total_cost(since=datetime.date.today().isoformat())
+
+
+class BudgetExceeded(Exception):
+    pass
+
+
+class BudgetGuard:
+    """
+    Decides whether a batch can start another job without going over limit. Each job reserves
+    its estimated cost until it settles with what it actually cost. Callers should pass an
+    estimate for the job itself, see LetterMaker._job_estimate. Without one, the default estimate
+    is used: it starts at a worst case guess and becomes the average of the paid jobs once some
+    have finished.
+    """
+    def __init__(self, limit:float, estimate:float):
+        self.limit = limit
+        self.estimate = estimate
+        self.spent = 0.0
+        self.paid = 0
+        self.in_flight = 0
+        self.reserved = 0.0
+        self.lock = threading.Lock()
+
+    def reserve(self, estimate:Union[float, None]=None) -> Union[float, None]:
+        """
+        Reserve room for a job. Returns the amount reserved, to hand back to settle(), or None if
+        the job could take the spend over the limit.
+        """
+        with self.lock:
+            amount = self.estimate if estimate is None else estimate
+            if self.spent + self.reserved + amount > self.limit:
+                return None
+            self.in_flight += 1
+            self.reserved += amount
+            return amount
+
+    def settle(self, cost:float, reserved:float):
+        with self.lock:
+            self.in_flight -= 1
+            self.reserved -= reserved
+            self.spent += cost
+            if cost > 0:
+                self.paid += 1
+                self.estimate = self.spent / self.paid
@@ -0,0 +1,151 @@
+import hashlib
+import threading
+from typing import Union
+from .logger import logger
+
+SORT_FIELDS = ("index", "company", "job_title", "status", "response_count", "total_cost", "last_response")
+STATUSES = ("generated", "pending")
+MAX_PER_PAGE = 500
+
+
+def _last(values):
+    return values[-1] if values else None
+
+
+def _sort_key(field:str):
+    # None sorts first, strings ignore case, and ties fall back to the index so pages are stable
+    def key(row):
+        value = row[field]
+        if isinstance(value, str):
+            value = value.lower()
+        return (value is not None, 0 if value is None else value, row['index'])
+    return key
+
+
+def summarize(record) -> dict:
+    """
+    The listing row for a record, built from its metadata only so nothing is read from disk.
+    """
+    return {
+        "index": record['index'],
+        "company": record.get('company'),
+        "job_title": record.get('job_title'),
+        "status": "generated" if record.get('response_generated') else "pending",
+        "response_count": record.get('response_count') or 0,
+        "total_cost": record.get('total_cost') or 0.0,
+        "last_model": _last(record.get('response_model')),
+        "last_config": _last(record.get('response_config')),
+        "last_response": _last(record.get('response_timestamp')),
+        }
+
+
+def detail(record) -> dict:
+    """
+    Everything about one job, with its letters as a list of responses, oldest first.
+    """
+    row = summarize(record)
+    texts = record.get('response_text') or []
+    history = zip(texts,
+                  record.get('response_model') or [None] * len(texts),
+                  record.get('response_timestamp') or [None] * len(texts),
+                  record.get('response_cost') or [None] * len(texts),
+                  record.get('response_config') or [None] * len(texts))
+    row.update({
+        "job_description": record.get('job_description'),
+        "additional_info": record.get('additional_info'),
+        "similar_to": record.get('similar_to') or [],
+        "responses": [{"text": text, "model": model, "timestamp": timestamp, "cost": cost, "config": config}
+                      for text, model, timestamp, cost, config in history],
+        })
+    return row
+
+
+def record_etag(record) -> str:
+    """
+    Changes whenever a letter is added to the record, which is the only way records change.
+    """
+    key = (record['index'], record.get('response_count'), _last(record.get('response_timestamp')),
+           record.get('total_cost'))
+    return hashlib.sha1(repr(key).encode()).hexdigest()
+
+
+class JobListing:
+    """
+    Listing rows for every record in a QueryData object, for paging through the database without
+    touching the file.
+
+    The rows are rebuilt when the database's stamp changes, which happens on every write and
+    reload, and the orderings for each sort field are kept until then. The stamp also makes the
+    ETag of a page, so a client can ask again with If-None-Match and get a 304 until something
+    was written.
+    """
+    def __init__(self, data_obj):
+        self.data_obj = data_obj
+        self.mlog = logger
+        self.lock = threading.Lock()
+        self.stamp = None
+        self._rows = []
+        self._orders = {}
+
+    def _refresh(self):
+        stamp = self.data_obj.stamp
+        if self.stamp != stamp or len(self._rows) != len(self.data_obj):
+            self._rows = [summarize(record) for record in self.data_obj.data]
+            self._orders = {}
+            self.stamp = stamp
+            self.mlog.debug("rebuilt the job listing, %s rows", len(self._rows))
+
+    def _order(self, field:str) -> list:
+        order = self._orders.get(field)
+        if order is None:
+            order = self._orders[field] = sorted(self._rows, key=_sort_key(field))
+        return order
+
+    def etag(self, *params) -> str:
+        with self.lock:
+            self._refresh()
+            return hashlib.sha1(repr((self.stamp, len(self._rows), params)).encode()).hexdigest()
+
+    def page(self,
+             page:int=1,
+             per_page:int=50,
+             sort:str="index",
+             status:Union[str, None]=None,
+             company:Union[str, None]=None,
+             min_cost:Union[float, None]=None,
+             max_cost:Union[float, None]=None) -> dict:
+        """
+        One page of the rows that pass the filters. sort names a field in SORT_FIELDS, with a
+        leading - for descending order. company matches case-insensitively anywhere in the name,
+        and the cost range is inclusive on total_cost. Raises ValueError for a bad argument.
+        """
+        descending = sort.startswith("-")
+        field = sort.lstrip("-")
+        if field not in SORT_FIELDS:
+            raise ValueError(f"sort must be one of {', '.join(SORT_FIELDS)}")
+        if status is not None and status not in STATUSES:
+            raise ValueError(f"status must be one of {', '.join(STATUSES)}")
+        if page < 1 or not 1 <= per_page <= MAX_PER_PAGE:
+            raise ValueError(f"page must be at least 1 and per_page between 1 and {MAX_PER_PAGE}")
+        company = company.lower() if company else None
+
+        with self.lock:
+            self._refresh()
+            rows = self._order(field)
+        if descending:
+            rows = reversed(rows)
+        if status is not None or company is not None or min_cost is not None or max_cost is not None:
+            rows = (row for row in rows
+                    if (status is None or row['status'] == status)
+                    and (company is None or company in (row['company'] or "").lower())
+                    and (min_cost is None or row['total_cost'] >= min_cost)
+                    and (max_cost is None or row['total_cost'] <= max_cost))
+        rows = list(rows)
+        start = (page - 1) * per_page
+        return {
+            "total": len(rows),
+            "page": page,
+            "per_page": per_page,
+            "pages": -(-len(rows) // per_page),
+            "items": rows[start:start + per_page],
+            }
@@ -1,23 +1,35 @@
-import logging
 import datetime
+import json
+import logging
+import os
+import random
+
+# Fraction of hot path events that get logged, see log_event
+LOG_SAMPLE = float(os.environ.get("AIPG_LOG_SAMPLE", 1.0))
+# Lowest level that gets logged. The per-query debug lines are only formatted when this is DEBUG
+LOG_LEVEL = os.environ.get("AIPG_LOG_LEVEL", "INFO").upper()
 
 def get_logger():
-    # Create custom logger logging all five levels 
+    # Create custom logger logging from LOG_LEVEL up
     logger = logging.getLogger(__name__)
-    logger.setLevel(logging.DEBUG)
+    if logger.handlers:
+        # already configured, another call would add a second set of handlers
+        return logger
+    logger.setLevel(LOG_LEVEL)
 
     # Define format for logs
     fmt = '%(asctime)s | %(levelname)8s | %(filename)s:%(lineno)2d | %(message)s'
 
-    # Create stdout handler for logging to the console (logs all five levels)
+    # Create stdout handler for logging to the console
     stdout_handler = logging.StreamHandler()
-    stdout_handler.setLevel(logging.DEBUG)
+    stdout_handler.setLevel(LOG_LEVEL)
     stdout_handler.setFormatter(logging.Formatter(fmt))
 
-    # Create file handler for logging to a file (logs all five levels)
+    # Create file handler for logging to a file. delay=True leaves the file
+    # unopened until the first record is written, so importing the package does no file I/O.
     today = datetime.date.today()
-    file_handler = logging.FileHandler('my_app_{}.log'.format(today.strftime('%Y_%m_%d')))
-    file_handler.setLevel(logging.DEBUG)
+    file_handler = logging.FileHandler('my_app_{}.log'.format(today.strftime('%Y_%m_%d')), delay=True)
+    file_handler.setLevel(LOG_LEVEL)
     file_handler.setFormatter(logging.Formatter(fmt))
 
     # Add both handlers to the logger
@@ -26,4 +38,17 @@ def get_logger():
 
     return logger
 
+def log_event(log:logging.Logger, event:str, level:int=logging.INFO, sample:float=None, **fields):
+    """
+    Log one event as its name followed by its fields as JSON, e.g.
+    query.done {"model": "gpt-3.5-turbo", "latency": 1.2}. Nothing is formatted unless the level
+    is enabled and the event survives sampling. sample defaults to AIPG_LOG_SAMPLE.
+    """
+    if not log.isEnabledFor(level):
+        return
+    rate = LOG_SAMPLE if sample is None else sample
+    if rate < 1.0 and random.random() >= rate:
+        return
+    log.log(level, "%s %s", event, json.dumps(fields, default=str), stacklevel=2)
+
 logger = get_logger()
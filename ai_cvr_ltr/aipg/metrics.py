@@ -0,0 +1,195 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Iterable, Union
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+IO_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0)
+
+
+def _label_key(labels:Union[dict, None]) -> tuple:
+    return tuple(sorted(labels.items())) if labels else ()
+
+
+def _format_labels(key:tuple, extra:Union[dict, None]=None) -> str:
+    pairs = list(key) + sorted((extra or {}).items())
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in pairs) + "}"
+
+
+class Counter:
+    """
+    Monotonic count, optionally split by labels: counter.inc(3, kind="prompt").
+    """
+    kind = "counter"
+
+    def __init__(self, name:str, help:str=""):
+        self.name = name
+        self.help = help
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def inc(self, amount:float=1, **labels):
+        key = _label_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self.values.get(_label_key(labels), 0)
+
+    def samples(self) -> Iterable[tuple]:
+        with self.lock:
+            items = list(self.values.items())
+        for key, value in items:
+            yield self.name, key, None, value
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {_format_labels(key) or "value": value for key, value in self.values.items()}
+
+
+class Gauge:
+    """
+    A value that goes up and down. Either set it, or pass a function that is called whenever the
+    metrics are read, e.g. to report a queue depth that lives somewhere else.
+    """
+    kind = "gauge"
+
+    def __init__(self, name:str, help:str="", fn:Union[Callable, None]=None):
+        self.name = name
+        self.help = help
+        self.fn = fn
+        self.current = 0.0
+
+    def set(self, value:float):
+        self.current = value
+
+    def value(self) -> float:
+        if self.fn is None:
+            return self.current
+        try:
+            return self.fn()
+        except Exception:
+            return float("nan")
+
+    def samples(self) -> Iterable[tuple]:
+        yield self.name, (), None, self.value()
+
+    def snapshot(self) -> dict:
+        return {"value": self.value()}
+
+
+class Histogram:
+    """
+    Distribution of observations in cumulative buckets, with their sum and count.
+    """
+    kind = "histogram"
+
+    def __init__(self, name:str, help:str="", buckets:tuple=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(sorted(buckets))
+        self.lock = threading.Lock()
+        self.series = {}
+
+    def observe(self, value:float, **labels):
+        key = _label_key(labels)
+        slot = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = {"counts": [0] * (len(self.buckets) + 1), "sum": 0.0, "count": 0}
+            series["counts"][slot] += 1
+            series["sum"] += value
+            series["count"] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self) -> Iterable[tuple]:
+        with self.lock:
+            items = [(key, list(series["counts"]), series["sum"], series["count"])
+                     for key, series in self.series.items()]
+        for key, counts, total, count in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                yield f"{self.name}_bucket", key, {"le": "+Inf" if bound == float("inf") else bound}, cumulative
+            yield f"{self.name}_sum", key, None, total
+            yield f"{self.name}_count", key, None, count
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {_format_labels(key) or "value": {"count": series["count"],
+                                                     "sum": series["sum"],
+                                                     "mean": series["sum"] / series["count"]}
+                    for key, series in self.series.items() if series["count"]}
+
+
+class MetricsRegistry:
+    """
+    Named metrics for the whole process. Asking for a name that already exists returns the
+    existing metric, so modules can declare what they record at import time.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+
+    def _get(self, cls, name:str, **kwargs):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = cls(name, **kwargs)
+            return metric
+
+    def counter(self, name:str, help:str="") -> Counter:
+        return self._get(Counter, name, help=help)
+
+    def gauge(self, name:str, help:str="", fn:Union[Callable, None]=None) -> Gauge:
+        gauge = self._get(Gauge, name, help=help)
+        if fn is not None:
+            gauge.fn = fn
+        return gauge
+
+    def histogram(self, name:str, help:str="", buckets:tuple=LATENCY_BUCKETS) -> Histogram:
+        return self._get(Histogram, name, help=help, buckets=buckets)
+
+    def render(self) -> str:
+        """
+        The metrics in the Prometheus text exposition format.
+        """
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            if metric.help:
+                lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, key, extra, value in metric.samples():
+                lines.append(f"{name}{_format_labels(key, extra)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return {metric.name: metric.snapshot() for metric in metrics}
+
+
+metrics = MetricsRegistry()
+
+API_LATENCY = metrics.histogram("aipg_api_latency_seconds", "Completion request latency, retries included")
+TOKENS = metrics.counter("aipg_tokens_total", "Tokens billed, by kind")
+COST = metrics.counter("aipg_cost_usd_total", "USD spent on letters")
+LETTERS = metrics.counter("aipg_letters_total", "Letters recorded, by status")
+CACHE = metrics.counter("aipg_response_cache_total", "Response cache lookups, by result")
+RETRIES = metrics.counter("aipg_scheduler_retries_total", "Requests retried by the scheduler")
+ORPHANED = metrics.counter("aipg_orphaned_responses_total", "Responses that arrived after their job timed out")
+PERSIST = metrics.histogram("aipg_persist_seconds", "Time spent writing the job database", buckets=IO_BUCKETS)
+OVER_BUDGET = metrics.counter("aipg_prompt_over_budget_total", "Prompts whose fixed parts alone left no room for the job listing")
@@ -0,0 +1,54 @@
+import threading
+from .logger import logger
+
+# USD per 1000 tokens as (prompt, completion). Dated snapshots are listed where their price differs
+# from the alias, lookups fall back to the longest matching prefix.
+PRICING = {
+    "gpt-3.5-turbo": (0.0015, 0.002),
+    "gpt-3.5-turbo-0301": (0.002, 0.002),
+    "gpt-3.5-turbo-16k": (0.003, 0.004),
+    "gpt-4": (0.03, 0.06),
+    "gpt-4-32k": (0.06, 0.12),
+    }
+DEFAULT_PRICE = PRICING["gpt-3.5-turbo"]
+
+_lock = threading.Lock()
+_warned = set()
+
+
+def register_model(model:str, prompt:float, completion:float):
+    """
+    Add or override the price of a model, in USD per 1000 prompt and completion tokens.
+    """
+    with _lock:
+        PRICING[model] = (prompt, completion)
+
+
+def price_for(model:str) -> tuple:
+    with _lock:
+        if model in PRICING:
+            return PRICING[model]
+        matches = [name for name in PRICING if model.startswith(name)]
+        if matches:
+            return PRICING[max(matches, key=len)]
+        if model not in _warned:
+            _warned.add(model)
+            logger.warning(f"No price registered for {model}, using the {DEFAULT_PRICE} default")
+        return DEFAULT_PRICE
+
+
+def cost_for(model:str, usage:dict) -> float:
+    """
+    Cost of a request from its usage block. Usage without the prompt/completion split is priced
+    entirely at the completion rate, so it errs on the high side.
+    """
+    prompt_rate, completion_rate = price_for(model)
+    prompt_tokens = usage.get('prompt_tokens')
+    completion_tokens = usage.get('completion_tokens')
+    if prompt_tokens is None or completion_tokens is None:
+        return usage.get('total_tokens', 0) * completion_rate / 1000
+    return (prompt_tokens * prompt_rate + completion_tokens * completion_rate) / 1000
+
+
+def estimate_cost(model:str, prompt_tokens:int, completion_tokens:int) -> float:
+    return cost_for(model, {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens})
@@ -0,0 +1,230 @@
+import logging
+import os
+import threading
+from collections import OrderedDict
+from typing import Union
+from .logger import log_event, logger
+from .metrics import OVER_BUDGET
+from .tokens import DEFAULT_MODEL, count_message_tokens, count_tokens, get_encoding
+
+# Sections whose heading mentions one of these are what the letter is written against, so they are
+# the last to go when a description has to be cut down. Boilerplate sections go first.
+KEY_SECTIONS = ("requirement", "responsibilit", "qualification", "skill", "experience", "you will",
+                "you'll", "what you", "the role", "duties", "must have", "nice to have")
+BOILERPLATE = ("equal opportunity", "benefit", "perks", "about us", "privacy", "salary", "compensation",
+               "accommodation", "disclaimer", "how to apply")
+# the lines of a job query that say which job it is, never cut when the description is compacted
+HEADER_FIELDS = ("Company:", "Position Title:")
+# the least of the description that is sent, even when that takes the prompt over its budget
+MIN_DESCRIPTION_TOKENS = 200
+
+
+class PromptCache:
+    """
+    Holds everything in a prompt that doesn't depend on the job: the pinfo and template file
+    contents, the messages before and after the job listing, and their token count.
+
+    File contents are keyed on path plus mtime and size, and the assembled messages on the config
+    name plus every config field that goes into them, so a stale entry can't be served even if an
+    invalidate() call is missed.
+
+    The token counts and compacted text of recent job descriptions are kept as well, so variants
+    of one job under several configs or models only tokenize its description once.
+    """
+    def __init__(self, model:str=DEFAULT_MODEL, max_descriptions:int=256):
+        self.model = model
+        self.mlog = logger
+        self.lock = threading.Lock()
+        self._files = {}
+        self._prompts = {}
+        self._descriptions = OrderedDict()
+        self.max_descriptions = max_descriptions
+
+    def read_file(self, path:Union[str, os.PathLike]) -> str:
+        stat = os.stat(path)
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        with self.lock:
+            cached = self._files.get(path)
+        if cached and cached[0] == stamp:
+            return cached[1]
+        with open(path, 'r') as file:
+            text = file.read()
+        with self.lock:
+            self._files[path] = (stamp, text)
+        return text
+
+    def _key(self, config:dict) -> tuple:
+        return (config.get('name'),
+                config['system_message'],
+                config['instructions'],
+                config['first_message'],
+                config['pinfo'],
+                config['template'])
+
+    def get(self, config:dict) -> dict:
+        """
+        Return the cached prompt parts for config, building them if the config or either file
+        changed. Raises FileNotFoundError when pinfo or template is missing.
+        """
+        pinfo = self.read_file(config['pinfo'])
+        template = self.read_file(config['template'])
+        key = self._key(config) + (pinfo, template)
+
+        with self.lock:
+            cached = self._prompts.get(config.get('name'))
+        if cached and cached[0] == key:
+            return cached[1]
+
+        head = [
+            {"role": "system", "content": config['system_message']},
+            {"role": "user", "content": config['instructions']},
+            {"role": "assistant", "content": config['first_message']},
+            {"role": "user", "content": "Here is my info: " + pinfo},
+            {"role": "assistant", "content": "Great! What job are you applying for?"},
+        ]
+        tail = [
+            {"role": "assistant", "content": "Great! What letter template should use?"},
+            {"role": "user", "content": "Here it is: " + template},
+        ]
+        parts = {"head": head, "tail": tail, "tokens": count_message_tokens(head + tail, self.model)}
+        self.mlog.debug("built prompt prefix for config %s: %s tokens", config.get('name'), parts['tokens'])
+        with self.lock:
+            self._prompts[config.get('name')] = (key, parts)
+        return parts
+
+    def messages(self, config:dict, description:str, budget:Union[int, None]=None):
+        """
+        Assemble the full message list for a job. When budget is set and the prompt would be larger,
+        the description is cut down with compact_description until it fits.
+
+        The company and title lines are always kept, and the description never goes below
+        MIN_DESCRIPTION_TOKENS. When the rest of the prompt leaves less room than that, the prompt
+        goes over budget, which is logged and counted in aipg_prompt_over_budget_total.
+
+        Returns the messages, their prompt token count, and the count before any compaction.
+        """
+        parts = self.get(config)
+        framing = parts['tokens'] + 4 + count_tokens("user", self.model) + count_tokens("This is the job listing: ", self.model)
+        raw_tokens = framing + self._description(description, None)[1]
+        tokens = raw_tokens
+        if budget and raw_tokens > budget:
+            header, body = split_header(description)
+            fixed = framing + (count_tokens(header + "\n", self.model) if header else 0)
+            room = budget - fixed
+            if room < MIN_DESCRIPTION_TOKENS:
+                OVER_BUDGET.inc()
+                log_event(self.mlog, "prompt.over_budget", level=logging.WARNING, sample=1.0,
+                          config=config.get('name'), budget=budget, fixed_tokens=fixed)
+                room = MIN_DESCRIPTION_TOKENS
+            body, body_tokens = self._description(body, room)
+            description = f"{header}\n{body}" if header else body
+            tokens = fixed + body_tokens
+            self.mlog.info("compacted job description: %s -> %s prompt tokens", raw_tokens, tokens)
+
+        job_message = {"role": "user", "content": "This is the job listing: " + description}
+        return parts['head'] + [job_message] + parts['tail'], tokens, raw_tokens
+
+    def _description(self, description:str, max_tokens:Union[int, None]) -> tuple:
+        """
+        The description cut down to max_tokens (unchanged when max_tokens is None) and its token
+        count, from the cache when the same description was seen recently.
+        """
+        key = (description, max_tokens)
+        with self.lock:
+            cached = self._descriptions.get(key)
+            if cached is not None:
+                self._descriptions.move_to_end(key)
+                return cached
+        text = description if max_tokens is None else compact_description(description, max_tokens, self.model)
+        result = (text, count_tokens(text, self.model))
+        with self.lock:
+            self._descriptions[key] = result
+            while len(self._descriptions) > self.max_descriptions:
+                self._descriptions.popitem(last=False)
+        return result
+
+    def invalidate(self, name:Union[str, None]=None):
+        """
+        Drop the cached prompt for config name, or everything when name is None.
+        """
+        with self.lock:
+            if name is None:
+                self._prompts.clear()
+                self._files.clear()
+            else:
+                self._prompts.pop(name, None)
+
+
+def split_header(description:str) -> tuple:
+    """
+    Split a job query into its leading Company/Position Title lines and the rest.
+    """
+    lines = description.split("\n")
+    n = 0
+    while n < len(lines) and lines[n].startswith(HEADER_FIELDS):
+        n += 1
+    return "\n".join(lines[:n]), "\n".join(lines[n:])
+
+
+def _is_heading(line:str) -> bool:
+    line = line.strip()
+    if not line or len(line.split()) > 8:
+        return False
+    return line.endswith(":") or line.startswith("#") or (line.isupper() and len(line) > 3)
+
+
+def _split_sections(text:str) -> list:
+    """
+    Break a description into sections at blank lines and at lines that look like headings.
+    """
+    sections = []
+    current = []
+    for line in text.splitlines():
+        if not line.strip() or (current and _is_heading(line)):
+            if current:
+                sections.append("\n".join(current))
+            current = [line] if line.strip() else []
+        else:
+            current.append(line)
+    if current:
+        sections.append("\n".join(current))
+    return sections
+
+
+def _section_score(section:str) -> int:
+    heading = section.split("\n", 1)[0].lower()
+    body = section.lower()
+    if any(word in heading for word in KEY_SECTIONS):
+        return 2
+    if any(word in heading for word in BOILERPLATE):
+        return -1
+    if any(word in body for word in KEY_SECTIONS):
+        return 1
+    return 0
+
+
+def compact_description(text:str, max_tokens:int, model:str=DEFAULT_MODEL) -> str:
+    """
+    Cut a job description down to max_tokens. Sections are kept by priority (requirements and
+    responsibilities first, boilerplate last, earlier sections before later ones) and put back in
+    their original order. If even the top section is too long it is truncated. The result only
+    depends on the input, so the same posting always compacts to the same prompt.
+    """
+    encoding = get_encoding(model)
+    if len(encoding.encode(text)) <= max_tokens:
+        return text
+
+    sections = _split_sections(text)
+    costs = [len(encoding.encode(section)) + 1 for section in sections]
+    ranked = sorted(range(len(sections)), key=lambda n: (-_section_score(sections[n]), n))
+
+    kept = set()
+    used = 0
+    for n in ranked:
+        if used + costs[n] <= max_tokens:
+            kept.add(n)
+            used += costs[n]
+    if kept:
+        return "\n".join(sections[n] for n in sorted(kept))
+
+    return encoding.decode(encoding.encode(sections[ranked[0]] if sections else text)[:max_tokens])
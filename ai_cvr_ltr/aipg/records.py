@@ -0,0 +1,182 @@
+import sys
+from collections.abc import MutableMapping
+from typing import Iterable, Union
+
+# fields with a slot on every record, the rest of a record's keys go in a small dict
+FIELDS = (
+    "index",
+    "company",
+    "job_title",
+    "job_description",
+    "additional_info",
+    "num_tokens",
+    "response_generated",
+    "response_count",
+    "response_text",
+    "response_model",
+    "response_timestamp",
+    "response_cost",
+    "response_config",
+    "total_cost",
+    "prompt_tokens_before",
+    "prompt_tokens_after",
+    "similar_to",
+    )
+# the bulk of a record, left on disk once the record is bound to a line of the job database
+LAZY_FIELDS = frozenset({"job_description", "response_text"})
+# values repeated across thousands of records, interned so they share one string
+INTERNED = frozenset({"company", "job_title"})
+INTERNED_LISTS = frozenset({"response_model", "response_config"})
+
+_SLOTS = frozenset(FIELDS)
+_MISSING = object()
+
+
+class _OnDisk:
+    __slots__ = ()
+
+    def __repr__(self):
+        return "<on disk>"
+
+ON_DISK = _OnDisk()
+
+
+def _intern(key:str, value):
+    if key in INTERNED and type(value) is str:
+        return sys.intern(value)
+    if key in INTERNED_LISTS and type(value) is list:
+        return [sys.intern(item) if type(item) is str else item for item in value]
+    return value
+
+
+class JobRecord(MutableMapping):
+    """
+    One job in the database. It behaves like the dict it replaces, but keeps its fields in slots,
+    interns the company and title strings, and can leave job_description and response_text on
+    disk.
+
+    Once bind() points a record at the line it was written to, those fields are read back from
+    the file each time they are accessed instead of being held in memory, so only the metadata
+    stays resident. Because of that, change a lazy field by assigning it a new value, not by
+    mutating what was read; the assigned value stays in memory until the record is written and
+    bound again.
+    """
+    __slots__ = FIELDS + ("_extra", "_source", "_offset", "_length")
+
+    def __init__(self, data:Union[dict, Iterable, None]=None, **fields):
+        self._extra = None
+        self._source = None
+        if data is not None:
+            self.update(data)
+        if fields:
+            self.update(fields)
+
+    @classmethod
+    def from_dict(cls, data:dict) -> "JobRecord":
+        if isinstance(data, cls):
+            return data
+        return cls(data)
+
+    def _raw(self, key:str):
+        if key in _SLOTS:
+            return getattr(self, key, _MISSING)
+        if self._extra is None:
+            return _MISSING
+        return self._extra.get(key, _MISSING)
+
+    def _read(self) -> dict:
+        return self._source.read(self._offset, self._length)
+
+    def __getitem__(self, key:str):
+        value = self._raw(key)
+        if value is _MISSING:
+            raise KeyError(key)
+        if value is ON_DISK:
+            return self._read()[key]
+        return value
+
+    def __setitem__(self, key:str, value):
+        value = _intern(key, value)
+        if key in _SLOTS:
+            setattr(self, key, value)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def __delitem__(self, key:str):
+        if self._raw(key) is _MISSING:
+            raise KeyError(key)
+        if key in _SLOTS:
+            delattr(self, key)
+        else:
+            del self._extra[key]
+
+    def __contains__(self, key) -> bool:
+        return self._raw(key) is not _MISSING
+
+    def __iter__(self):
+        for key in FIELDS:
+            if hasattr(self, key):
+                yield key
+        if self._extra:
+            yield from self._extra
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+    def items(self):
+        """
+        The record's fields, reading anything left on disk in one go.
+        """
+        return self.to_dict().items()
+
+    def values(self):
+        return self.to_dict().values()
+
+    def to_dict(self) -> dict:
+        """
+        A plain dict copy of the record with every field in memory.
+        """
+        stored = None
+        data = {}
+        for key in self:
+            value = self._raw(key)
+            if value is ON_DISK:
+                if stored is None:
+                    stored = self._read()
+                value = stored[key]
+            data[key] = value
+        return data
+
+    def bind(self, source, offset:int, length:int):
+        """
+        Record that this record was written to source at offset and release its large fields.
+        source is anything with a read(offset, length) method returning the record as a dict.
+        """
+        self._source = source
+        self._offset = offset
+        self._length = length
+        for key in LAZY_FIELDS:
+            if hasattr(self, key):
+                setattr(self, key, ON_DISK)
+
+    def on_disk(self, key:str) -> bool:
+        return self._raw(key) is ON_DISK
+
+    def __reduce__(self):
+        # the file handle stays behind, a copy sent to another process carries its fields
+        return (self.__class__, (self.to_dict(),))
+
+    def __repr__(self):
+        fields = {key: self._raw(key) for key in self}
+        return f"{self.__class__.__name__}({fields!r})"
+
+
+def as_dict(record) -> dict:
+    """
+    record as a plain dict, for json.dumps and the like.
+    """
+    if isinstance(record, JobRecord):
+        return record.to_dict()
+    return record
@@ -0,0 +1,42 @@
+import os
+import threading
+from typing import Union
+from .ai_request import LetterMaker
+from .logger import logger
+
+
+class MakerRegistry:
+    """
+    Application scoped LetterMakers, one per (data_dir, config_path, config_name), so a web
+    request reuses the loaded job database and config instead of parsing both again. A maker is
+    reloaded only when one of its files changed on disk behind its back, which costs two stat
+    calls per lookup.
+
+    Makers are shared between threads. Anything that mutates maker.config should hold maker.lock.
+    """
+    def __init__(self, **maker_kwargs):
+        self.maker_kwargs = maker_kwargs
+        self.lock = threading.Lock()
+        self.mlog = logger
+        self._makers = {}
+
+    def get(self,
+            data_dir:Union[str, os.PathLike],
+            config_path:Union[str, os.PathLike],
+            config_name:Union[str, None]="default") -> LetterMaker:
+        key = (os.path.abspath(data_dir), os.path.abspath(config_path), config_name)
+        with self.lock:
+            maker = self._makers.get(key)
+            if maker is None:
+                self.mlog.info(f"creating LetterMaker for {key}")
+                maker = LetterMaker(data_dir, config_path=config_path, config_name=config_name,
+                                    **self.maker_kwargs)
+                self._makers[key] = maker
+                return maker
+        if maker.is_stale():
+            maker.reload()
+        return maker
+
+    def clear(self):
+        with self.lock:
+            self._makers.clear()
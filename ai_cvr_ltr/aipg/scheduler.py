@@ -0,0 +1,209 @@
+import random
+import threading
+import time
+from typing import Callable, Union
+from .handles import ResponseTimeout
+from .logger import logger
+from .metrics import RETRIES
+from .tokens import count_message_tokens
+
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket. Callers reserve capacity up front and are told how long to sleep
+    before the reservation is covered, so the bucket can run into debt instead of making waiters
+    poll it.
+    """
+    def __init__(self, capacity:float, per_minute:float):
+        self.capacity = capacity
+        self.rate = per_minute / 60.0
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount:float) -> float:
+        amount = min(amount, self.capacity)
+        with self.lock:
+            self._refill()
+            self.tokens -= amount
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+    def refund(self, amount:float):
+        with self.lock:
+            self._refill()
+            self.tokens = min(self.capacity, self.tokens + amount)
+
+
+class RequestScheduler:
+    """
+    Keeps OpenAI calls inside the requests-per-minute and tokens-per-minute budgets and retries
+    rate limit and server errors with jittered exponential backoff.
+
+    The prompt side of the token budget is counted with tiktoken before the call is made, the
+    completion side is estimated with completion_tokens and corrected once the usage comes back.
+    """
+    def __init__(self,
+                 rpm:int=3500,
+                 tpm:int=90000,
+                 max_retries:int=5,
+                 base_delay:float=1.0,
+                 max_delay:float=60.0,
+                 completion_tokens:int=500):
+        self.requests = TokenBucket(rpm, rpm)
+        self.tokens = TokenBucket(tpm, tpm)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.completion_tokens = completion_tokens
+        self.mlog = logger
+        self.lock = threading.Lock()
+        self.queue_depth = 0
+        self.wait_time = 0.0
+        self.request_count = 0
+        self.retry_count = 0
+        self.failure_count = 0
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "queue_depth": self.queue_depth,
+                "wait_time": self.wait_time,
+                "requests": self.request_count,
+                "retries": self.retry_count,
+                "failures": self.failure_count,
+                }
+
+    def _wait_for_budget(self, tokens:int):
+        with self.lock:
+            self.queue_depth += 1
+        try:
+            delay = max(self.requests.reserve(1), self.tokens.reserve(tokens))
+            if delay > 0:
+                self.mlog.debug("rate limiter holding request for %.2fs", delay)
+                time.sleep(delay)
+        finally:
+            with self.lock:
+                self.queue_depth -= 1
+                self.wait_time += delay
+
+    def _backoff(self, attempt:int, err:Exception) -> float:
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        headers = getattr(err, 'headers', None) or {}
+        retry_after = headers.get('retry-after')
+        if retry_after:
+            try:
+                delay = max(delay, float(retry_after))
+            except ValueError:
+                pass
+        return delay
+
+    def submit(self,
+               create:Callable,
+               messages:list,
+               model:str,
+               max_tokens:Union[int, None]=None,
+               prompt_tokens:Union[int, None]=None,
+               deadline:Union[float, None]=None,
+               **kwargs):
+        """
+        Call create(model=model, messages=messages, **kwargs) once the budgets allow it, retrying
+        retryable errors. The last error is re-raised when the retries run out.
+
+        prompt_tokens skips counting the messages when the caller already knows the count.
+
+        deadline is a time.monotonic() time after which the caller has given up on the response.
+        No attempt starts or backoff sleeps past it, and each attempt's request_timeout is cut to
+        the time that is left, so nothing keeps running and billing after the caller moved on.
+        ResponseTimeout is raised once the deadline is reached.
+
+        An attempt that raises gives its tokens back to the tokens-per-minute budget, a rejected
+        request didn't use any.
+        """
+        if prompt_tokens is None:
+            prompt_tokens = count_message_tokens(messages, model)
+        estimate = prompt_tokens + (max_tokens or self.completion_tokens)
+        if max_tokens:
+            kwargs['max_tokens'] = max_tokens
+
+        import openai
+
+        def remaining(delay:float=0.0) -> Union[float, None]:
+            if deadline is None:
+                return None
+            left = deadline - time.monotonic() - delay
+            if left <= 0:
+                with self.lock:
+                    self.failure_count += 1
+                raise ResponseTimeout(f"gave up after {attempt} retries, the caller's deadline passed")
+            return left
+
+        timeout = kwargs.get('request_timeout')
+        attempt = 0
+        while True:
+            self._wait_for_budget(estimate)
+            try:
+                left = remaining()
+            except ResponseTimeout:
+                self.tokens.refund(estimate)
+                raise
+            if left is not None:
+                kwargs['request_timeout'] = left if timeout is None else min(timeout, left)
+            with self.lock:
+                self.request_count += 1
+            try:
+                response = create(model=model, messages=messages, **kwargs)
+            except openai.error.OpenAIError as err:
+                self.tokens.refund(estimate)
+                if not is_retryable(err) or attempt >= self.max_retries:
+                    with self.lock:
+                        self.failure_count += 1
+                    raise
+                delay = self._backoff(attempt, err)
+                remaining(delay)
+                attempt += 1
+                with self.lock:
+                    self.retry_count += 1
+                    self.wait_time += delay
+                RETRIES.inc()
+                self.mlog.warning(f"retry {attempt}/{self.max_retries} in {delay:.2f}s after: {err}")
+                time.sleep(delay)
+                continue
+
+            usage = response.get('usage') if hasattr(response, 'get') else None
+            if usage and usage.get('total_tokens'):
+                self.tokens.refund(estimate - usage['total_tokens'])
+            return response
+
+
+def is_retryable(err:Exception) -> bool:
+    if getattr(err, 'http_status', None) in RETRY_STATUS:
+        return True
+    import openai
+    return isinstance(err, (openai.error.RateLimitError,
+                            openai.error.ServiceUnavailableError,
+                            openai.error.Timeout,
+                            openai.error.APIConnectionError))
+
+
+_default_scheduler = None
+_default_lock = threading.Lock()
+
+def default_scheduler() -> RequestScheduler:
+    """
+    Rate limits apply to the API key, not to a LetterMaker, so makers share one scheduler per
+    process unless they are handed their own.
+    """
+    global _default_scheduler
+    with _default_lock:
+        if _default_scheduler is None:
+            _default_scheduler = RequestScheduler()
+        return _default_scheduler
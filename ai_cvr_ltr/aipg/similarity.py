@@ -0,0 +1,216 @@
+import os
+import re
+import threading
+import zlib
+from typing import Iterable, Union
+from .logger import logger
+from .storage import file_lock
+
+WORD = re.compile(r"\w+")
+MAGIC = 0x4D484958  # "MHIX"
+MAX_HASH = (1 << 32) - 1
+MERSENNE = (1 << 61) - 1
+
+
+def shingles(text:str, size:int=3) -> set:
+    """
+    The set of lowercased word size-grams in text.
+    """
+    words = WORD.findall(text.lower())
+    if len(words) <= size:
+        return {" ".join(words)} if words else set()
+    return {" ".join(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+
+class SimilarityIndex:
+    """
+    MinHash signatures of job descriptions, bucketed with LSH, for finding near-duplicate postings
+    without comparing every pair. Everything runs locally, numpy is imported on first use.
+
+    A description is reduced to its set of word 3-grams. Two descriptions agree on any one slot of
+    their signatures with probability equal to the Jaccard similarity of those sets, so the share
+    of matching slots estimates it. Signatures are cut into bands, and only postings that share a
+    whole band with the query are compared.
+
+    Signatures are appended to a binary file next to the job database as they are added, so
+    saving costs the new rows only. The file is a cache: anything missing from it is recomputed
+    from the records by sync().
+    """
+    def __init__(self,
+                 path:Union[str, os.PathLike],
+                 num_perm:int=128,
+                 bands:int=16,
+                 threshold:float=0.8,
+                 seed:int=1):
+        if num_perm % bands:
+            raise ValueError("num_perm must be a multiple of bands")
+        self.path = path
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows_per_band = num_perm // bands
+        self.threshold = threshold
+        self.seed = seed
+        self.mlog = logger
+        self.lock = threading.RLock()
+        self.loaded = False
+        self._perms = None
+        self._signatures = {}
+        self._buckets = {}
+        self._unsaved = []
+        self._synced = 0
+
+    def __len__(self) -> int:
+        return len(self._signatures)
+
+    def __contains__(self, index:int) -> bool:
+        return index in self._signatures
+
+    def _header(self):
+        import numpy as np
+        return np.array([MAGIC, self.num_perm, self.bands, self.seed], dtype=np.uint32)
+
+    def signature(self, text:str):
+        """
+        The MinHash signature of text, or None when it has no words to hash.
+        """
+        import numpy as np
+        grams = shingles(text or "")
+        if not grams:
+            return None
+        if self._perms is None:
+            rng = np.random.RandomState(self.seed)
+            self._perms = (rng.randint(1, MERSENNE, size=self.num_perm, dtype=np.uint64)[:, None],
+                           rng.randint(0, MERSENNE, size=self.num_perm, dtype=np.uint64)[:, None])
+        a, b = self._perms
+        hashes = np.fromiter((zlib.crc32(gram.encode()) for gram in grams), dtype=np.uint64, count=len(grams))
+        # uint64 arithmetic wraps around, which keeps the permutations cheap and still well mixed
+        values = (a * hashes + b) % MERSENNE
+        return (values & MAX_HASH).min(axis=1).astype(np.uint32)
+
+    def _band_keys(self, signature) -> Iterable[tuple]:
+        for band in range(self.bands):
+            start = band * self.rows_per_band
+            yield band, signature[start:start + self.rows_per_band].tobytes()
+
+    def _insert(self, index:int, signature):
+        self._signatures[index] = signature
+        for key in self._band_keys(signature):
+            self._buckets.setdefault(key, []).append(index)
+
+    def _matches(self, data) -> bool:
+        import numpy as np
+        return data.size >= 4 and np.array_equal(data[:4], self._header())
+
+    def load(self):
+        """
+        Read the signature file if it was written with the same parameters, else start empty.
+        """
+        import numpy as np
+        with self.lock:
+            self.loaded = True
+            if not os.path.exists(self.path):
+                return
+            with file_lock(self.path, shared=True):
+                data = np.fromfile(self.path, dtype=np.uint32)
+            if not self._matches(data):
+                # removed under the lock the appends take, after checking again that it still differs
+                with file_lock(self.path):
+                    if not os.path.exists(self.path):
+                        return
+                    data = np.fromfile(self.path, dtype=np.uint32)
+                    if not self._matches(data):
+                        self.mlog.warning("ignoring %s, it was built with other parameters", self.path)
+                        os.remove(self.path)
+                        return
+            width = self.num_perm + 1
+            rows = data[4:]
+            # a crash mid-append can leave a partial row at the end
+            rows = rows[:rows.size - rows.size % width].reshape(-1, width)
+            for row in rows:
+                if int(row[0]) not in self._signatures:
+                    self._insert(int(row[0]), row[1:].copy())
+            self.mlog.info("loaded %s signatures from %s", len(self._signatures), self.path)
+
+    def save(self):
+        """
+        Append the signatures added since the last save.
+        """
+        import numpy as np
+        with self.lock:
+            if not self._unsaved:
+                return
+            rows = np.vstack([np.concatenate(([index], signature)).astype(np.uint32)
+                              for index, signature in self._unsaved])
+            with file_lock(self.path):
+                with open(self.path, 'ab') as file:
+                    if file.tell() == 0:
+                        file.write(self._header().tobytes())
+                    file.write(rows.tobytes())
+            self._unsaved.clear()
+
+    def add(self, index:int, text:str, signature=None):
+        """
+        Index text under the job index. Returns False if the index was already there or the text
+        has nothing to hash.
+        """
+        with self.lock:
+            if not self.loaded:
+                self.load()
+            if index in self._signatures:
+                return False
+            if signature is None:
+                signature = self.signature(text)
+            if signature is None:
+                return False
+            self._insert(index, signature)
+            self._unsaved.append((index, signature))
+            return True
+
+    def sync(self, records:list, field:str="job_description") -> int:
+        """
+        Add every record that isn't indexed yet. Returns how many were added.
+
+        Records are only ever appended, so each call starts where the last one stopped.
+        """
+        with self.lock:
+            if not self.loaded:
+                self.load()
+            if self._synced > len(records):
+                self._synced = 0
+            added = sum(1 for record in records[self._synced:]
+                        if record['index'] not in self._signatures and self.add(record['index'], record.get(field)))
+            self._synced = len(records)
+            if added:
+                self.mlog.info("indexed %s new descriptions for similarity", added)
+            return added
+
+    def query(self,
+              text:Union[str, None]=None,
+              signature=None,
+              threshold:Union[float, None]=None,
+              exclude:Union[int, None]=None,
+              limit:int=10) -> list:
+        """
+        Indexed postings whose estimated Jaccard similarity to text is at least threshold, as
+        (index, similarity) pairs with the closest first.
+        """
+        import numpy as np
+        threshold = self.threshold if threshold is None else threshold
+        with self.lock:
+            if not self.loaded:
+                self.load()
+            if signature is None:
+                signature = self.signature(text)
+            if signature is None:
+                return []
+            candidates = set()
+            for key in self._band_keys(signature):
+                candidates.update(self._buckets.get(key, ()))
+            candidates.discard(exclude)
+            matches = []
+            for index in candidates:
+                score = float(np.mean(self._signatures[index] == signature))
+                if score >= threshold:
+                    matches.append((index, score))
+        matches.sort(key=lambda match: (-match[1], match[0]))
+        return matches[:limit]
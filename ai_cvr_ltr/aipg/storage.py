@@ -0,0 +1,354 @@
+import json
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+from typing import Callable, Union
+from .logger import logger
+from .records import JobRecord, as_dict
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class VersionConflict(Exception):
+    """
+    A save was based on data that someone else has changed since it was read.
+    """
+
+
+_thread_locks = {}
+_thread_locks_guard = threading.Lock()
+_held = threading.local()
+
+@contextmanager
+def file_lock(path:Union[str, os.PathLike], shared:bool=False):
+    """
+    Advisory lock on path, held on a separate path.lock file because atomic writes replace the
+    file itself. Exclusive locks are also serialized between threads of this process, since flock
+    locks belong to the open file and don't exclude other threads. The lock is reentrant within a
+    thread, and where fcntl is unavailable only the thread lock applies.
+    """
+    key = os.path.abspath(path)
+    held = _held.__dict__.setdefault("depth", {})
+    if held.get(key):
+        held[key] += 1
+        try:
+            yield
+        finally:
+            held[key] -= 1
+        return
+
+    with _thread_locks_guard:
+        thread_lock = _thread_locks.setdefault(key, threading.Lock())
+    if not shared:
+        thread_lock.acquire()
+    held[key] = 1
+    try:
+        if fcntl is None:
+            yield
+            return
+        with open(f"{key}.lock", 'a') as lock_file:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+    finally:
+        held[key] = 0
+        if not shared:
+            thread_lock.release()
+
+
+def file_stamp(path:Union[str, os.PathLike]):
+    """
+    Cheap fingerprint of a file's current contents: (mtime_ns, size), or None if it doesn't exist.
+    """
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+# os.umask can only be read by setting it, which isn't safe once other threads create files
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+def _file_mode(path:Union[str, os.PathLike]) -> int:
+    try:
+        return os.stat(path).st_mode & 0o7777
+    except FileNotFoundError:
+        return 0o666 & ~_UMASK
+
+
+def atomic_write(path:Union[str, os.PathLike], write, mode:str='w'):
+    """
+    Call write(file) on a temporary file next to path and move it over path once it is complete,
+    so a crash mid-write leaves the old file intact. Pass mode='wb' for binary data.
+
+    mkstemp creates the file readable by its owner only, so it is given the permissions of the file
+    it replaces, or the umask default for a new file, before it is moved into place.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp_", suffix=os.path.basename(path))
+    try:
+        os.chmod(tmp_path, _file_mode(path))
+        with os.fdopen(fd, mode) as tmp_file:
+            write(tmp_file)
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def read_json(path:Union[str, os.PathLike]):
+    """
+    Returns the parsed file and its version, a file_stamp to compare against later.
+    """
+    with file_lock(path, shared=True):
+        version = file_stamp(path)
+        with open(path, 'r') as file:
+            return json.load(file), version
+
+
+def write_json(path:Union[str, os.PathLike], data, indent:int=4):
+    """
+    Atomically replace path with data under an exclusive lock.
+    """
+    with file_lock(path):
+        atomic_write(path, lambda file: json.dump(data, file, indent=indent))
+        return file_stamp(path)
+
+
+def update_json(path:Union[str, os.PathLike], update:Callable, indent:int=4):
+    """
+    Read-modify-write path under an exclusive lock. update receives the parsed file, changes it in
+    place or returns a replacement, and the result is written back atomically. Returns the data
+    written and the new version.
+    """
+    with file_lock(path):
+        with open(path, 'r') as file:
+            data = json.load(file)
+        result = update(data)
+        if result is not None:
+            data = result
+        atomic_write(path, lambda file: json.dump(data, file, indent=indent))
+        return data, file_stamp(path)
+
+
+class JSONStorage:
+    """
+    The original job_data.json format: one JSON list holding every record. Every save rewrites the
+    whole file, so this is kept for import/export; the default database is the .jsonl log, which
+    migrate_json starts from an existing job_data.json. There is no
+    line to point back into, so its records keep every field in memory.
+    """
+    def __init__(self, path:Union[str, os.PathLike], indent:int=4):
+        self.path = path
+        self.indent = indent
+        self.mlog = logger
+
+    def load(self) -> list:
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path, 'r') as db_file:
+            return json.load(db_file)
+
+    def load_records(self, visit:Union[Callable, None]=None) -> list:
+        """
+        The records as JobRecords. visit, if given, is called with each record as it is loaded.
+        """
+        records = []
+        for data in self.load():
+            if visit is not None:
+                visit(data)
+            records.append(JobRecord.from_dict(data))
+        return records
+
+    def save(self, records:list, changed:Union[list, None]=None):
+        atomic_write(self.path, lambda file: json.dump([as_dict(record) for record in records], file, indent=self.indent))
+
+
+class LogFile:
+    """
+    A read-only handle on one version of the log. Records bound to it read their large fields
+    back with pread, which needs no seek and is safe across threads.
+
+    Each record holds on to the handle its offsets belong to. A compaction, ours or another
+    process's, replaces the log with a new file, but an open handle keeps reading the old one, so
+    a record never reads from the wrong offset. The handle closes once no record refers to it.
+    """
+    __slots__ = ("path", "fd", "inode")
+
+    def __init__(self, path:Union[str, os.PathLike]):
+        self.path = path
+        self.fd = os.open(path, os.O_RDONLY)
+        self.inode = os.fstat(self.fd).st_ino
+
+    def current(self) -> bool:
+        """
+        True while path still names the file this handle has open.
+        """
+        try:
+            return os.stat(self.path).st_ino == self.inode
+        except FileNotFoundError:
+            return False
+
+    def read(self, offset:int, length:int) -> dict:
+        return json.loads(os.pread(self.fd, length, offset))
+
+    def __del__(self):
+        try:
+            os.close(self.fd)
+        except (AttributeError, OSError):
+            pass
+
+
+class JSONLStorage:
+    """
+    Append-only log with one record per line. Saving only appends the records that changed, and
+    loading keeps the last line written for each index. Once the log holds compact_ratio times as
+    many lines as there are records it is rewritten with one line per record.
+
+    load_records() keeps the offset of each record's line rather than its large fields, see
+    JobRecord, so a big log costs little more than its metadata in memory.
+    """
+    def __init__(self, path:Union[str, os.PathLike], compact_ratio:float=2.0):
+        self.path = path
+        self.compact_ratio = compact_ratio
+        self.line_count = 0
+        self.mlog = logger
+        self._log_file = None
+
+    def _handle(self) -> LogFile:
+        """
+        A handle on the log as it is now, reopened if the file was replaced since the last one.
+        """
+        if self._log_file is None or not self._log_file.current():
+            self._log_file = LogFile(self.path)
+        return self._log_file
+
+    def load(self) -> list:
+        if not os.path.exists(self.path):
+            return []
+        records = {}
+        self.line_count = 0
+        with open(self.path, 'r') as log_file:
+            for line in log_file:
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # a torn final line from a crash mid-append
+                    self.mlog.warning(f"Skipping unreadable line {self.line_count + 1} in {self.path}")
+                    continue
+                records[record['index']] = record
+                self.line_count += 1
+        return list(records.values())
+
+    def load_records(self, visit:Union[Callable, None]=None) -> list:
+        """
+        The records as JobRecords bound to their lines in the log. visit, if given, is called with
+        each line's record while all of its fields are still at hand.
+        """
+        if not os.path.exists(self.path):
+            return []
+        records = {}
+        self.line_count = 0
+        self._log_file = None
+        handle = self._handle()
+        offset = 0
+        with open(handle.fd, 'rb', closefd=False) as log_file:
+            log_file.seek(0)
+            for line in log_file:
+                start, offset = offset, offset + len(line)
+                if not line.strip():
+                    continue
+                try:
+                    data = json.loads(line)
+                except ValueError:
+                    self.mlog.warning(f"Skipping unreadable line {self.line_count + 1} in {self.path}")
+                    continue
+                if visit is not None:
+                    visit(data)
+                record = JobRecord.from_dict(data)
+                record.bind(handle, start, len(line))
+                records[record['index']] = record
+                self.line_count += 1
+        return list(records.values())
+
+    @staticmethod
+    def _lines(records:list) -> list:
+        return [json.dumps(as_dict(record)).encode() + b"\n" for record in records]
+
+    @staticmethod
+    def _bind(records:list, lines:list, handle:LogFile, offset:int):
+        for record, line in zip(records, lines):
+            if isinstance(record, JobRecord):
+                record.bind(handle, offset, len(line))
+            offset += len(line)
+
+    def save(self, records:list, changed:Union[list, None]=None):
+        if changed is None:
+            self.compact(records)
+            return
+        lines = self._lines(changed)
+        with open(self.path, 'ab') as log_file:
+            offset = log_file.seek(0, os.SEEK_END)
+            log_file.write(b"".join(lines))
+            log_file.flush()
+            os.fsync(log_file.fileno())
+        self._bind(changed, lines, self._handle(), offset)
+        self.line_count += len(changed)
+        if records and self.line_count > self.compact_ratio * len(records):
+            self.compact(records)
+
+    def compact(self, records:list):
+        self.mlog.info(f"Compacting {self.path}: {self.line_count} lines -> {len(records)} records")
+        lines = self._lines(records)
+        atomic_write(self.path, lambda file: file.write(b"".join(lines)), mode='wb')
+        self._bind(records, lines, self._handle(), 0)
+        self.line_count = len(records)
+
+    def import_json(self, json_path:Union[str, os.PathLike]) -> list:
+        records = JSONStorage(json_path).load()
+        self.compact(records)
+        return records
+
+    def export_json(self, json_path:Union[str, os.PathLike], records:Union[list, None]=None):
+        if records is None:
+            records = sorted(self.load(), key=lambda x: x['index'])
+        JSONStorage(json_path).save(records)
+
+
+def migrate_json(db_path:Union[str, os.PathLike]) -> bool:
+    """
+    Start a .jsonl log that doesn't exist yet from the job_data.json next to it, if there is one.
+    The .json file is left where it is. Returns True if records were imported.
+    """
+    json_path = f"{os.path.splitext(db_path)[0]}.json"
+    if not str(db_path).endswith(".jsonl") or os.path.exists(db_path) or not os.path.exists(json_path):
+        return False
+    with file_lock(db_path):
+        if os.path.exists(db_path):
+            return False
+        records = JSONLStorage(db_path).import_json(json_path)
+    logger.info("Migrated %s records from %s to the append log %s", len(records), json_path, db_path)
+    return True
+
+
+def get_storage(db_path:Union[str, os.PathLike]):
+    """
+    Pick the storage backend from the file extension. .jsonl gets the append log, anything else
+    the plain JSON file.
+    """
+    if str(db_path).endswith(".jsonl"):
+        return JSONLStorage(db_path)
+    return JSONStorage(db_path)
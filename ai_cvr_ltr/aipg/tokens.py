@@ -0,0 +1,33 @@
+from functools import lru_cache
+
+DEFAULT_MODEL = "gpt-3.5-turbo"
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model:str=DEFAULT_MODEL):
+    """
+    Return the tiktoken encoding for a model. Encodings are cached since building one is expensive,
+    and tiktoken itself is only imported the first time one is needed.
+    """
+    import tiktoken
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def count_tokens(text:str, model:str=DEFAULT_MODEL) -> int:
+    return len(get_encoding(model).encode(text))
+
+
+def count_message_tokens(messages:list, model:str=DEFAULT_MODEL) -> int:
+    """
+    Estimate the prompt tokens of a chat message list. Every message carries a few tokens of
+    framing on top of its content, and the reply is primed with another three.
+    """
+    num_tokens = 3
+    for message in messages:
+        num_tokens += 4
+        for value in message.values():
+            num_tokens += count_tokens(value, model)
+    return num_tokens
@@ -0,0 +1,411 @@
+"""
+Generate cover letters for a selection of the job database across several processes.
+
+    python -m ai_cvr_ltr.batch                                  # every job without a letter
+    python -m ai_cvr_ltr.batch --indexes 3 7 10-20 --processes 4
+    python -m ai_cvr_ltr.batch --all --where "'python' in job_description.lower() and total_cost == 0"
+    python -m ai_cvr_ltr.batch --configs default concise    # A/B two prompt configs across the jobs
+
+Each process runs its own LetterMaker over a share of the rate limits and sends the transaction
+records back. The parent writes them to the job database and the cost ledger every --flush-every
+letters and checkpoints the finished indexes, so an interrupted run resumes where it stopped
+when started again with the same selection.
+"""
+import argparse
+import ast
+import hashlib
+import json
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from itertools import zip_longest
+from typing import Union
+from .aipg.ai_request import LetterMaker
+from .aipg.logger import logger
+from .aipg.scheduler import RequestScheduler
+from .aipg.storage import write_json
+
+_maker = None
+
+STRING_METHODS = {"lower", "upper", "strip", "startswith", "endswith", "count"}
+FUNCTIONS = {"len": len, "any": any, "all": all, "min": min, "max": max, "sum": sum}
+OPERATORS = {
+    ast.Add: lambda a, b: a + b,
+    ast.Sub: lambda a, b: a - b,
+    ast.Mult: lambda a, b: a * b,
+    ast.Div: lambda a, b: a / b,
+    ast.Mod: lambda a, b: a % b,
+    ast.Eq: lambda a, b: a == b,
+    ast.NotEq: lambda a, b: a != b,
+    ast.Lt: lambda a, b: a < b,
+    ast.LtE: lambda a, b: a <= b,
+    ast.Gt: lambda a, b: a > b,
+    ast.GtE: lambda a, b: a >= b,
+    ast.In: lambda a, b: a in b,
+    ast.NotIn: lambda a, b: a not in b,
+    }
+
+
+class JobFilter:
+    """
+    A filter expression over the fields of a job record, e.g.
+    "company == 'Acme' or response_count < 2". The expression is parsed once and evaluated by
+    walking the tree, so only names, literals, comparisons, boolean and arithmetic operators,
+    a few builtins and string methods are available. Nothing is passed to eval.
+    """
+    def __init__(self, expression:str):
+        self.expression = expression
+        try:
+            self.tree = ast.parse(expression, mode="eval").body
+        except SyntaxError as err:
+            raise ValueError(f"invalid filter expression {expression!r}: {err.msg}")
+
+    def __call__(self, job:dict) -> bool:
+        return bool(self._eval(self.tree, job))
+
+    def _eval(self, node, job:dict):
+        if isinstance(node, ast.Constant):
+            return node.value
+        if isinstance(node, ast.Name):
+            if node.id not in job:
+                raise ValueError(f"unknown field {node.id!r} in filter")
+            return job[node.id]
+        if isinstance(node, (ast.List, ast.Tuple, ast.Set)):
+            return [self._eval(elt, job) for elt in node.elts]
+        if isinstance(node, ast.BoolOp):
+            values = (self._eval(value, job) for value in node.values)
+            return all(values) if isinstance(node.op, ast.And) else any(values)
+        if isinstance(node, ast.UnaryOp):
+            operand = self._eval(node.operand, job)
+            if isinstance(node.op, ast.Not):
+                return not operand
+            if isinstance(node.op, ast.USub):
+                return -operand
+        if isinstance(node, ast.BinOp) and type(node.op) in OPERATORS:
+            return OPERATORS[type(node.op)](self._eval(node.left, job), self._eval(node.right, job))
+        if isinstance(node, ast.Compare):
+            left = self._eval(node.left, job)
+            for op, comparator in zip(node.ops, node.comparators):
+                if type(op) not in OPERATORS:
+                    break
+                right = self._eval(comparator, job)
+                if not OPERATORS[type(op)](left, right):
+                    return False
+                left = right
+            else:
+                return True
+        if isinstance(node, ast.Call) and not node.keywords:
+            args = [self._eval(arg, job) for arg in node.args]
+            if isinstance(node.func, ast.Name) and node.func.id in FUNCTIONS:
+                return FUNCTIONS[node.func.id](*args)
+            if isinstance(node.func, ast.Attribute) and node.func.attr in STRING_METHODS:
+                target = self._eval(node.func.value, job)
+                if isinstance(target, str):
+                    return getattr(target, node.func.attr)(*args)
+        raise ValueError(f"unsupported syntax in filter: {ast.unparse(node)}")
+
+
+def parse_indexes(values:list) -> set:
+    """
+    Turn arguments like ["3", "7", "10-20", "30,31"] into a set of indexes, ranges inclusive.
+    """
+    indexes = set()
+    for value in values:
+        for part in value.split(","):
+            if not part:
+                continue
+            if "-" in part:
+                start, end = part.split("-", 1)
+                indexes.update(range(int(start), int(end) + 1))
+            else:
+                indexes.add(int(part))
+    return indexes
+
+
+def select_jobs(job_data:list,
+                new_only:bool=True,
+                indexes:Union[set, None]=None,
+                where:Union[JobFilter, None]=None) -> list:
+    selected = []
+    for job in job_data:
+        if new_only and job.get('response_generated'):
+            continue
+        if indexes is not None and job['index'] not in indexes:
+            continue
+        if where is not None and not where(job):
+            continue
+        selected.append(job)
+    return selected
+
+
+def selection_id(args) -> str:
+    """
+    Identifies a selection so a checkpoint is only resumed by a run that asked for the same jobs.
+    """
+    selection = {
+        "data": os.path.abspath(args.data),
+        "configs": args.configs or [args.config_name],
+        "new_only": not args.all,
+        "indexes": sorted(parse_indexes(args.indexes)) if args.indexes else None,
+        "where": args.where,
+        }
+    return hashlib.sha1(json.dumps(selection, sort_keys=True).encode()).hexdigest()[:16]
+
+
+class Checkpoint:
+    """
+    The indexes a batch has finished, kept in a small JSON file next to the job database. It is
+    only written after the records it lists have been flushed to the database.
+    """
+    def __init__(self, path:str, selection:str):
+        self.path = path
+        self.selection = selection
+        self.done = set()
+        self.failed = set()
+        self.letters = 0
+        self.cost = 0.0
+
+    def load(self) -> bool:
+        if not os.path.exists(self.path):
+            return False
+        with open(self.path, 'r') as file:
+            state = json.load(file)
+        if state.get('selection') != self.selection:
+            logger.warning(f"ignoring checkpoint {self.path}, it belongs to a different selection")
+            return False
+        self.done = set(state['done'])
+        self.failed = set(state['failed'])
+        self.letters = state['letters']
+        self.cost = state['cost']
+        return True
+
+    def save(self):
+        write_json(self.path, {
+            "selection": self.selection,
+            "updated": time.time(),
+            "done": sorted(self.done),
+            "failed": sorted(self.failed),
+            "letters": self.letters,
+            "cost": self.cost,
+            }, indent=None)
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class Progress:
+    """
+    One status line on stderr, rewritten as chunks finish.
+    """
+    def __init__(self, total:int, stream=sys.stderr):
+        self.total = total
+        self.stream = stream
+        self.start = time.perf_counter()
+        self.done = 0
+        self.letters = 0
+        self.failed = 0
+        self.cost = 0.0
+
+    def add(self, records:list):
+        for record in records:
+            self.done += 1
+            if record.get('response_generated'):
+                self.letters += 1
+                self.cost += record.get('response_cost') or 0.0
+            else:
+                self.failed += 1
+
+    def line(self) -> str:
+        elapsed = time.perf_counter() - self.start
+        rate = self.done / elapsed if elapsed else 0.0
+        eta = (self.total - self.done) / rate if rate else 0.0
+        return (f"{self.done}/{self.total} jobs  {self.letters} letters  {self.failed} failed  "
+                f"{rate:.2f} jobs/s  ${self.cost:.4f}  eta {eta:.0f}s")
+
+    def show(self):
+        end = "\r" if self.stream.isatty() else "\n"
+        print(self.line(), end=end, file=self.stream, flush=True)
+
+
+def _init_worker(data:str, config_path:str, config_name:str, rpm:float, tpm:float, timeout:float):
+    global _maker
+    scheduler = RequestScheduler(rpm=rpm, tpm=tpm)
+    # the parent records the letters, the worker's ledger only takes the cost of responses that
+    # arrive after their job timed out, which the parent never sees
+    _maker = LetterMaker(data, config_path=config_path, config_name=config_name,
+                         scheduler=scheduler, timeout=timeout)
+
+
+def _run_chunk(jobs:list, threads:int, config_name:str) -> list:
+    """
+    Runs in a worker process. Returns the transaction records for the parent to write.
+    """
+    config = _maker.config_for(config_name)
+    if threads > 1 and len(jobs) > 1:
+        return _maker._batch_query(jobs, threads, variants=[(config, None)])
+    records = []
+    for job in jobs:
+        try:
+            record, _ = _maker._process_job(job, config)
+        except Exception as err:
+            logger.exception(f"query for index {job['index']} raised:\n{err}")
+            record = _maker._failed_record(job['index'])
+        records.append(record)
+    return records
+
+
+def run_batch(args) -> int:
+    maker = LetterMaker(args.data, config_path=args.config, config_name=args.config_name,
+                        daily_budget=args.daily_budget)
+    indexes = parse_indexes(args.indexes) if args.indexes else None
+    where = JobFilter(args.where) if args.where else None
+    jobs = select_jobs(maker.job_data, new_only=not args.all, indexes=indexes, where=where)
+
+    checkpoint = Checkpoint(args.checkpoint or f"{args.data}.checkpoint.json", selection_id(args))
+    if args.restart:
+        checkpoint.clear()
+    elif checkpoint.load():
+        print(f"resuming from {checkpoint.path}: {len(checkpoint.done)} jobs already done", file=sys.stderr)
+    jobs = [job for job in jobs if job['index'] not in checkpoint.done]
+    if args.limit is not None:
+        jobs = jobs[:args.limit]
+    if not jobs:
+        print("nothing to do", file=sys.stderr)
+        checkpoint.clear()
+        return 0
+
+    # with several configs each job gets one by its index, so a resumed run assigns the same ones
+    configs = args.configs or [args.config_name]
+    unknown = [name for name in configs if name not in maker.configs]
+    if unknown:
+        raise ValueError(f"no config named {', '.join(unknown)} in {args.config}")
+    processes = max(1, min(args.processes, len(jobs)))
+    chunk_size = args.chunk_size or max(1, args.threads)
+    groups = []
+    for n, name in enumerate(configs):
+        group = [job for job in jobs if job['index'] % len(configs) == n]
+        groups.append([(name, group[i:i + chunk_size]) for i in range(0, len(group), chunk_size)])
+    # interleave the configs so a run cut short by the budget still covers each of them
+    chunks = [chunk for row in zip_longest(*groups) for chunk in row if chunk is not None]
+    guard = maker._budget_guard(args.budget)
+    progress = Progress(len(jobs))
+    pending = []
+
+    def flush():
+        if not pending:
+            return
+        totals = maker._update_transaction_record(pending)
+        for record in pending:
+            if record.get('response_generated'):
+                checkpoint.done.add(record['index'])
+                checkpoint.failed.discard(record['index'])
+            else:
+                checkpoint.failed.add(record['index'])
+        checkpoint.letters += totals['letters']
+        checkpoint.cost += totals['cost']
+        checkpoint.save()
+        pending.clear()
+
+    print(f"generating {len(jobs)} letters with {processes} processes x {args.threads} threads"
+          f" using {', '.join(configs)}", file=sys.stderr)
+    stopped = None
+    initargs = (args.data, args.config, args.config_name,
+                maker.scheduler.requests.rate * 60 / processes, maker.scheduler.tokens.rate * 60 / processes,
+                args.timeout)
+    with ProcessPoolExecutor(max_workers=processes, initializer=_init_worker, initargs=initargs) as pool:
+        futures = {}
+        queue = list(reversed(chunks))
+
+        def fill():
+            while queue and len(futures) < processes * 2:
+                name, chunk = queue.pop()
+                reserved = {}
+                if guard is not None:
+                    config = maker.config_for(name)
+                    for job in chunk:
+                        amount = guard.reserve(maker._job_estimate(job, config))
+                        if amount is None:
+                            break
+                        reserved[job['index']] = amount
+                    if len(reserved) < len(chunk):
+                        queue.clear()
+                        allowed = chunk[:len(reserved)]
+                        if allowed:
+                            futures[pool.submit(_run_chunk, allowed, args.threads, name)] = (allowed, reserved)
+                        return "budget"
+                futures[pool.submit(_run_chunk, chunk, args.threads, name)] = (chunk, reserved)
+
+        try:
+            stopped = fill()
+            while futures:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    chunk, reserved = futures.pop(future)
+                    try:
+                        records = future.result()
+                    except Exception as err:
+                        logger.exception(f"worker failed on indexes {[job['index'] for job in chunk]}:\n{err}")
+                        records = [maker._failed_record(job['index']) for job in chunk]
+                    if guard is not None:
+                        for record in records:
+                            guard.settle(record.get('response_cost') or 0.0, reserved.pop(record['index'], 0.0))
+                    pending.extend(records)
+                    progress.add(records)
+                if len(pending) >= args.flush_every:
+                    flush()
+                progress.show()
+                if stopped is None:
+                    stopped = fill()
+        except KeyboardInterrupt:
+            stopped = "interrupted"
+            for future in futures:
+                future.cancel()
+        finally:
+            flush()
+
+    progress.show()
+    print(file=sys.stderr)
+    if stopped == "budget":
+        print(f"stopped at the budget cap, {checkpoint.path} has the progress", file=sys.stderr)
+        return 2
+    if stopped == "interrupted":
+        print(f"interrupted, run again with the same selection to resume from {checkpoint.path}", file=sys.stderr)
+        return 130
+    if checkpoint.failed:
+        print(f"{len(checkpoint.failed)} jobs failed: {sorted(checkpoint.failed)}", file=sys.stderr)
+        return 1
+    checkpoint.clear()
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--data", default=os.environ.get("AIPG_DATA_PATH", "./job_data.jsonl"))
+    parser.add_argument("--config", default=os.environ.get("AIPG_CONFIG_PATH", "./config.json"))
+    parser.add_argument("--config-name", default=os.environ.get("AIPG_CONFIG_NAME", "default"))
+    parser.add_argument("--configs", nargs="+", help="split the jobs between these configs by index")
+    selection = parser.add_argument_group("selection")
+    selection.add_argument("--all", action="store_true", help="include jobs that already have a letter")
+    selection.add_argument("--indexes", nargs="+", help="job indexes, ranges like 10-20 are inclusive")
+    selection.add_argument("--where", help="filter expression over the job fields")
+    selection.add_argument("--limit", type=int, help="stop after this many jobs")
+    parser.add_argument("--processes", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--threads", type=int, default=4, help="queries in flight per process")
+    parser.add_argument("--chunk-size", type=int, help="jobs handed to a process at once, defaults to --threads")
+    parser.add_argument("--flush-every", type=int, default=50, help="records to collect before writing them")
+    parser.add_argument("--timeout", type=float, default=120.0, help="seconds to wait for each letter")
+    parser.add_argument("--budget", type=float, help="USD cap for this run")
+    parser.add_argument("--daily-budget", type=float, help="USD cap for the day across runs")
+    parser.add_argument("--checkpoint", help="defaults to <data>.checkpoint.json")
+    parser.add_argument("--restart", action="store_true", help="ignore an existing checkpoint")
+    args = parser.parse_args()
+    try:
+        sys.exit(run_batch(args))
+    except ValueError as err:
+        parser.error(str(err))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,383 @@
+"""
+Offline throughput benchmark for the letter pipeline.
+
+Builds a throwaway workspace with a synthetic job database, runs LetterMaker.get_letter and the
+Flask routes against the mock completion backend, and reports letters/sec, p50/p99 latency and
+how the time splits between the query, persistence and cost ledger I/O.
+
+    python -m ai_cvr_ltr.bench --sizes 10 1000 100000 --latency 0.05 --workers 16
+    python -m ai_cvr_ltr.bench --imports     # cold import time of the package entry points
+    python -m ai_cvr_ltr.bench --memory --sizes 100000 --db-name job_data.json
+    python -m ai_cvr_ltr.bench --batch       # smoke run of the batch CLI, exits 1 if a job failed
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+from .aipg.ai_request import LetterMaker, QueryData
+from .aipg.backends import MockBackend
+from .aipg.scheduler import RequestScheduler
+
+IMPORT_TARGETS = ["ai_cvr_ltr.aipg.ai_request", "ai_cvr_ltr.aipg.data_utils", "ai_cvr_ltr.batch", "ai_cvr_ltr.main"]
+HEAVY_MODULES = ["openai", "tiktoken", "polars", "requests"]
+
+WORDS = ("python data pipeline team experience remote senior engineer build scale customers "
+         "product design systems cloud analytics requirements responsibilities qualifications").split()
+
+
+class Timings:
+    """
+    Wraps methods on live objects so every call is timed under a label.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = defaultdict(list)
+
+    def wrap(self, obj, name:str, label:str):
+        original = getattr(obj, name)
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                with self.lock:
+                    self.samples[label].append(elapsed)
+
+        setattr(obj, name, timed)
+
+    def total(self, label:str) -> float:
+        return sum(self.samples[label])
+
+
+def percentile(samples:list, pct:float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def synthetic_jobs(rows:int, seed:int=0) -> list:
+    rng = random.Random(seed)
+    jobs = []
+    for idx in range(rows):
+        jobs.append({
+            "index": idx,
+            "company": f"Company {idx}",
+            "job_title": f"{rng.choice(WORDS).title()} Engineer",
+            "job_description": " ".join(rng.choice(WORDS) for _ in range(rng.randint(150, 600))),
+            "additional_info": "",
+            "num_tokens": 0,
+            "response_generated": False,
+            "response_count": 0,
+            "response_text": [],
+            "response_model": [],
+            "response_timestamp": [],
+            "response_cost": [],
+            "response_config": [],
+            "total_cost": 0.0,
+            })
+    return jobs
+
+
+def make_workspace(directory:str, rows:int, db_name:str="job_data.jsonl") -> dict:
+    paths = {
+        "db": os.path.join(directory, db_name),
+        "config": os.path.join(directory, "config.json"),
+        "pinfo": os.path.join(directory, "pinfo.txt"),
+        "template": os.path.join(directory, "template.txt"),
+        }
+    with open(paths["pinfo"], "w") as file:
+        file.write("I write software. " * 50)
+    with open(paths["template"], "w") as file:
+        file.write("Dear hiring manager, ... Sincerely, me. " * 20)
+    config = {
+        "key": "offline",
+        "current_cost": 0,
+        "total_tokens": 0,
+        "configs": [{
+            "name": "default",
+            "token_count": 0,
+            "pinfo": paths["pinfo"],
+            "template": paths["template"],
+            "system_message": "You are a very helpful assistant.",
+            "instructions": "Help me write a cover letter.",
+            "first_message": "Can you please tell me about yourself?",
+            }],
+        }
+    with open(paths["config"], "w") as file:
+        json.dump(config, file, indent=4)
+    jobs = synthetic_jobs(rows)
+    with open(paths["db"], "w") as file:
+        if db_name.endswith(".jsonl"):
+            file.write("".join(json.dumps(job) + "\n" for job in jobs))
+        else:
+            json.dump(jobs, file)
+    return paths
+
+
+def bench_letters(rows:int, args) -> dict:
+    with tempfile.TemporaryDirectory() as directory:
+        paths = make_workspace(directory, rows, args.db_name)
+        backend = MockBackend(latency=args.latency, jitter=args.latency / 5,
+                              error_rate=args.error_rate, seed=rows)
+        scheduler = RequestScheduler(rpm=10**9, tpm=10**12, base_delay=0.01)
+
+        start = time.perf_counter()
+        maker = LetterMaker(paths["db"], config_path=paths["config"], backend=backend,
+                            scheduler=scheduler, response_cache=False)
+        load_time = time.perf_counter() - start
+
+        timings = Timings()
+        timings.wrap(maker, "query", "query")
+        timings.wrap(maker, "_process_job", "letter")
+        timings.wrap(maker, "_update_transaction_record", "transaction")
+        timings.wrap(maker.data_obj, "save_updates", "persistence")
+
+        jobs = maker.find_job_data()
+        start = time.perf_counter()
+        maker.get_letter(jobs, max_workers=args.workers)
+        elapsed = time.perf_counter() - start
+
+    letters = timings.samples["letter"]
+    persistence = timings.total("persistence")
+    return {
+        "rows": rows,
+        "seconds": elapsed,
+        "letters_per_sec": len(letters) / elapsed if elapsed else 0.0,
+        "p50": percentile(letters, 50),
+        "p99": percentile(letters, 99),
+        "load": load_time,
+        "query": timings.total("query"),
+        "persistence": persistence,
+        "ledger": timings.total("transaction") - persistence,
+        }
+
+
+def bench_routes(rows:int, args) -> dict:
+    """
+    Drive the Flask app through its test client from inside a workspace, since the app resolves
+    its default paths relative to the working directory. Repeated get_letter posts of the same job
+    are served from the response cache after the first one.
+    """
+    os.environ["AIPG_BACKEND"] = "mock"
+    os.environ["AIPG_MOCK_LATENCY"] = str(args.latency)
+    from .main import app
+
+    results = {}
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        make_workspace(directory, rows)
+        os.chdir(directory)
+        try:
+            client = app.test_client()
+            form = {
+                "name": "default",
+                "system_message": "You are a very helpful assistant.",
+                "instructions": "Help me write a cover letter.",
+                "first_message": "Can you please tell me about yourself?",
+                "pinfo": os.path.join(directory, "pinfo.txt"),
+                "template": os.path.join(directory, "template.txt"),
+                }
+            job = {"company": "Bench Co", "position": "Engineer", "description": "Build things.", "get_letter": "1"}
+            for label, call in (("GET /", lambda: client.get("/")),
+                                ("POST / get_letter", lambda: client.post("/", data=job)),
+                                ("POST /save_config", lambda: client.post("/save_config", data=form))):
+                samples = []
+                for _ in range(args.requests):
+                    start = time.perf_counter()
+                    call()
+                    samples.append(time.perf_counter() - start)
+                results[label] = {
+                    "rows": rows,
+                    "requests_per_sec": len(samples) / sum(samples),
+                    "p50": percentile(samples, 50),
+                    "p99": percentile(samples, 99),
+                    }
+        finally:
+            os.chdir(cwd)
+    return results
+
+
+def bench_memory(rows:int, args) -> dict:
+    """
+    Memory held by a loaded QueryData, as traced by tracemalloc, next to the size of the file it
+    was loaded from.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        paths = make_workspace(directory, rows, args.db_name)
+        size = os.path.getsize(paths["db"])
+        tracemalloc.start()
+        try:
+            start = time.perf_counter()
+            data = QueryData(paths["db"], similarity=False)
+            load_time = time.perf_counter() - start
+            held, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        del data
+    return {
+        "rows": rows,
+        "file_mb": size / 2**20,
+        "held_mb": held / 2**20,
+        "peak_mb": peak / 2**20,
+        "bytes_per_job": held / rows if rows else 0.0,
+        "load": load_time,
+        }
+
+
+def bench_batch(rows:int, args) -> dict:
+    """
+    Run the batch CLI end to end against the mock backend, with its default threads and chunking,
+    so a change that breaks the worker processes shows up as failed jobs instead of going unnoticed.
+    """
+    package_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, AIPG_BACKEND="mock", AIPG_MOCK_LATENCY=str(args.latency),
+               PYTHONPATH=os.pathsep.join(filter(None, [package_root, os.environ.get("PYTHONPATH")])))
+    with tempfile.TemporaryDirectory() as directory:
+        paths = make_workspace(directory, rows, args.db_name)
+        start = time.perf_counter()
+        proc = subprocess.run([sys.executable, "-m", "ai_cvr_ltr.batch", "--data", paths["db"],
+                               "--config", paths["config"], "--processes", "2"],
+                              capture_output=True, text=True, env=env, cwd=directory)
+        elapsed = time.perf_counter() - start
+        letters = sum(1 for job in LetterMaker(paths["db"], config_path=paths["config"],
+                                               response_cache=False, ledger=False).job_data
+                      if job['response_generated'])
+    lines = proc.stderr.strip().splitlines()
+    return {
+        "rows": rows,
+        "returncode": proc.returncode,
+        "letters": letters,
+        "seconds": elapsed,
+        "last_line": lines[-1] if lines else "",
+        }
+
+
+def bench_imports(args) -> list:
+    """
+    Import each target in a fresh interpreter, args.import_runs times, and report the median wall
+    time along with which of the heavy dependencies the import dragged in. The slowest modules
+    come from -X importtime on the last run.
+    """
+    package_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [package_root, os.environ.get("PYTHONPATH")])))
+    script = ("import json, sys, time\n"
+              "start = time.perf_counter()\n"
+              "import {module}\n"
+              "elapsed = time.perf_counter() - start\n"
+              "print(json.dumps([elapsed, [m for m in {heavy!r} if m in sys.modules]]))\n")
+    results = []
+    for module in IMPORT_TARGETS:
+        samples = []
+        for _ in range(args.import_runs):
+            proc = subprocess.run([sys.executable, "-X", "importtime", "-c",
+                                   script.format(module=module, heavy=HEAVY_MODULES)],
+                                  capture_output=True, text=True, env=env)
+            if proc.returncode:
+                break
+            elapsed, loaded = json.loads(proc.stdout.strip().splitlines()[-1])
+            samples.append(elapsed)
+        if not samples:
+            results.append({"module": module, "error": proc.stderr.strip().splitlines()[-1]})
+            continue
+
+        slowest = []
+        for line in proc.stderr.splitlines():
+            if not line.startswith("import time:") or "[us]" in line:
+                continue
+            self_us, cumulative_us, name = line[len("import time:"):].split("|")
+            slowest.append((int(self_us), name.strip()))
+        results.append({
+            "module": module,
+            "median": statistics.median(samples),
+            "min": min(samples),
+            "heavy_loaded": loaded,
+            "slowest": [{"module": name, "self": us / 1e6} for us, name in sorted(slowest, reverse=True)[:5]],
+            })
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--latency", type=float, default=0.05, help="mean mock API latency in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--db-name", default="job_data.jsonl", help="use a .json name for the single-file format")
+    parser.add_argument("--routes", action="store_true", help="also benchmark the Flask routes")
+    parser.add_argument("--requests", type=int, default=20, help="requests per route")
+    parser.add_argument("--imports", action="store_true", help="only measure cold import times")
+    parser.add_argument("--import-runs", type=int, default=5, help="fresh interpreters per import target")
+    parser.add_argument("--batch", action="store_true", help="only smoke run the batch CLI on the mock backend")
+    parser.add_argument("--memory", action="store_true", help="only measure the memory of a loaded database")
+    parser.add_argument("--json", action="store_true", help="print the raw results as JSON")
+    args = parser.parse_args()
+
+    if args.imports:
+        report = {"imports": bench_imports(args)}
+        if args.json:
+            print(json.dumps(report, indent=2))
+            return
+        for r in report["imports"]:
+            if "error" in r:
+                print(f"{r['module']:<30} failed: {r['error']}")
+                continue
+            print(f"{r['module']:<30} median {r['median'] * 1000:8.1f} ms  min {r['min'] * 1000:8.1f} ms  "
+                  f"heavy: {', '.join(r['heavy_loaded']) or '-'}")
+            for slow in r["slowest"]:
+                print(f"    {slow['module']:<40} {slow['self'] * 1000:8.1f} ms")
+        return
+
+    if args.batch:
+        report = {"batch": [bench_batch(rows, args) for rows in args.sizes]}
+        if args.json:
+            print(json.dumps(report, indent=2))
+        else:
+            for r in report["batch"]:
+                print(f"{r['rows']:>8} rows  {r['letters']:>8} letters  {r['seconds']:8.2f}s  "
+                      f"exit {r['returncode']}  {r['last_line']}")
+        if any(r['returncode'] or r['letters'] != r['rows'] for r in report["batch"]):
+            sys.exit(1)
+        return
+
+    if args.memory:
+        report = {"memory": [bench_memory(rows, args) for rows in args.sizes]}
+        if args.json:
+            print(json.dumps(report, indent=2))
+            return
+        print(f"{'rows':>8} {'file MB':>9} {'held MB':>9} {'peak MB':>9} {'B/job':>8} {'load':>8}")
+        for r in report["memory"]:
+            print(f"{r['rows']:>8} {r['file_mb']:>9.1f} {r['held_mb']:>9.1f} {r['peak_mb']:>9.1f} "
+                  f"{r['bytes_per_job']:>8.0f} {r['load']:>8.3f}")
+        return
+
+    report = {"letters": [bench_letters(rows, args) for rows in args.sizes]}
+    if args.routes:
+        report["routes"] = [bench_routes(rows, args) for rows in args.sizes]
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+
+    print(f"{'rows':>8} {'letters/s':>10} {'p50':>8} {'p99':>8} {'load':>8} {'query':>9} {'persist':>9} {'ledger':>8}")
+    for r in report["letters"]:
+        print(f"{r['rows']:>8} {r['letters_per_sec']:>10.1f} {r['p50']:>8.3f} {r['p99']:>8.3f} "
+              f"{r['load']:>8.3f} {r['query']:>9.2f} {r['persistence']:>9.3f} {r['ledger']:>8.3f}")
+    for routes in report.get("routes", []):
+        for label, r in routes.items():
+            print(f"{label:<20} rows={r['rows']:<8} {r['requests_per_sec']:>8.1f} req/s  "
+                  f"p50={r['p50']:.3f}s p99={r['p99']:.3f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,64 @@
 import os
-from aipg.ai_request import LetterMaker
-from flask import Flask, render_template, request, session
-import requests
+try:
+    from .aipg.ai_request import LetterMaker
+    from .aipg.job_queue import JobQueue, JobWorkerPool
+    from .aipg.ledger import BudgetExceeded
+    from .aipg.listing import detail, record_etag
+    from .aipg.logger import logger
+    from .aipg.metrics import metrics
+    from .aipg.registry import MakerRegistry
+    from .aipg.scheduler import default_scheduler
+    from .aipg.storage import VersionConflict
+except ImportError:
+    from aipg.ai_request import LetterMaker
+    from aipg.job_queue import JobQueue, JobWorkerPool
+    from aipg.ledger import BudgetExceeded
+    from aipg.listing import detail, record_etag
+    from aipg.logger import logger
+    from aipg.metrics import metrics
+    from aipg.registry import MakerRegistry
+    from aipg.scheduler import default_scheduler
+    from aipg.storage import VersionConflict
+import json
+import threading
+from typing import Union
+from flask import Flask, Response, jsonify, render_template, request, session, stream_with_context, url_for
 
 app = Flask(__name__)
+app.config.setdefault("DATA_PATH", os.environ.get("AIPG_DATA_PATH", "./job_data.jsonl"))
+app.config.setdefault("CONFIG_PATH", os.environ.get("AIPG_CONFIG_PATH", "./config.json"))
+app.config.setdefault("CONFIG_NAME", os.environ.get("AIPG_CONFIG_NAME", "default"))
+app.config.setdefault("JOB_QUEUE_PATH", os.environ.get("AIPG_JOB_QUEUE_PATH", "./job_queue.db"))
+app.config.setdefault("JOB_WORKERS", int(os.environ.get("AIPG_JOB_WORKERS", 2)))
+
+registry = MakerRegistry()
+_job_pool = None
+_job_pool_lock = threading.Lock()
+
+
+def get_maker() -> LetterMaker:
+    return registry.get(app.config["DATA_PATH"], app.config["CONFIG_PATH"], app.config["CONFIG_NAME"])
+
+def get_job_pool() -> JobWorkerPool:
+    """
+    The queue and its workers are started on first use so importing the app has no side effects.
+    """
+    global _job_pool
+    with _job_pool_lock:
+        if _job_pool is None:
+            _job_pool = JobWorkerPool(JobQueue(app.config["JOB_QUEUE_PATH"]), get_maker,
+                                      workers=app.config["JOB_WORKERS"])
+            _job_pool.start()
+        return _job_pool
+
+
+def job_queue_depth() -> int:
+    # only look at the queue once something has started it
+    return _job_pool.queue.depth() if _job_pool is not None else 0
+
+metrics.gauge("aipg_job_queue_depth", "Background jobs waiting for a worker", fn=job_queue_depth)
+metrics.gauge("aipg_scheduler_queue_depth", "Requests waiting on the rate limits",
+              fn=lambda: default_scheduler().stats()["queue_depth"])
 
 
 def trunc_line(line, length:int=30, head:int=15, tail:int=15):
@@ -23,22 +78,34 @@ def trunc_input(input):
             output += "...<br>"
     return output
 
-def update_config(l_maker:LetterMaker, new_config:dict):
+CONFIG_FIELDS = ("system_message", "instructions", "first_message", "pinfo", "template")
+
+def update_config(l_maker:LetterMaker, new_config:dict, expected_version:Union[int, None]=None):
+    """
+    Save the form's fields as the config called new_config['name'], starting from a copy of the
+    maker's config. The maker is shared by every request in the process, so its own config is
+    left alone; it picks the saved file up the next time it is fetched from the registry.
+
+    Raises VersionConflict when expected_version is given and the stored config has moved past it.
+    """
     name = new_config.pop("name")
-    print(f"Update_config func: saving {name}")
-    updaters = [l_maker.set_sysmsg, l_maker.set_instructions, l_maker.set_first_message,
-                l_maker.set_personal_info, l_maker.set_letter_template]
-    print("starting update loop...")
-    for input, func in zip(new_config.values(), updaters):
-        func(input)
-    print("finished loop, entering save_config()")
-    return l_maker.save_config(name)
+    logger.debug("update_config: saving %s", name)
+    config = dict(l_maker.config, name=name)
+    for field in CONFIG_FIELDS:
+        if new_config.get(field):
+            config[field] = new_config[field]
+        else:
+            logger.warning("update_config: no %s given, keeping %r", field, config.get(field))
+    saved = l_maker.configs.save(config, expected_version)
+    l_maker.prompt_cache.invalidate(name)
+    logger.info("Saved %s config version %s to %s", name, saved['version'], l_maker.config_path)
+    return saved
     
     
 @app.route('/save_config', methods=['POST'])
 def save_config():
 
-    maker = LetterMaker("./job_data.json", config_path="./config.json", config_name="default")
+    maker = get_maker()
 
     context = {
         "name": request.form['name'],
@@ -48,45 +115,61 @@ def save_config():
         "pinfo": request.form['pinfo'],
         "template": request.form['template']
         }
-    new_config = context
-    update_config(maker, new_config)
-
-    return render_template('index.html', **context)
+    # the form carries the name and version it was loaded with, a save to the same name has to
+    # start from the version that is stored now
+    expected = request.form.get('version', type=int) if request.form.get('base') == context['name'] else None
+    try:
+        saved = update_config(maker, dict(context), expected)
+    except VersionConflict as err:
+        return render_template('index.html', response=f"Not saved, {err}. Reload the page to edit the latest version.",
+                               version=expected, **context), 409
+    return render_template('index.html', version=saved['version'], **context)
 
 
 @app.route('/', methods=['GET', 'POST'])
 def index():        
      
-    maker = LetterMaker("./job_data.json", config_path="./config.txt", config_name="default")
-    if not maker:
+    try:
+        maker = get_maker()
+    except (FileNotFoundError, KeyError) as err:
+        app.logger.warning(f"could not load a LetterMaker: {err}")
         return render_template('noMaker.html')
 
+    # ?config=<name> or a config form field uses another saved config for this request only
+    config_name = request.values.get('config') or None
+    missing = config_name is not None and config_name not in maker.configs
+    config = maker.config if missing else maker.config_for(config_name)
+
     context = {
-        "name": f"{maker.config['name']}",
-        "system_message": f"{maker.config['system_message']}",
-        "instructions": f"{maker.config['instructions']}",
-        "first_message": f"{maker.config['first_message']}",
-        "pinfo": f"{maker.config['pinfo']}",
-        "template": f"{maker.config['template']}"
+        "name": f"{config['name']}",
+        "system_message": f"{config['system_message']}",
+        "instructions": f"{config['instructions']}",
+        "first_message": f"{config['first_message']}",
+        "pinfo": f"{config['pinfo']}",
+        "template": f"{config['template']}",
+        "version": config.get('version', 0),
     }
+    if missing:
+        return render_template('index.html', response=f"No config named {config_name}", **context), 404
    
 
     if request.method == 'POST':
         if 'get_letter' in request.form:
             # Get the form data
             job_data = {
-            	"company": request.form['company'],
-            	"position": request.form['position'],
-            	"description": request.form['description']
+                "company": request.form['company'],
+                "job_title": request.form['position'],
+                "job_description": request.form['description'],
+                "additional_info": "",
             }
             # job_query = f"Company: {company}\nPosition Title: {position}\ndescription: {description}"
 
-            response = maker.get_letter([job_data])
+            _, response = maker.letter_for(job_data, config_name=config_name)
             # Send a request to the external server
             # Display the response on the page
-            if response['choices']:
+            if response.get('choices'):
                 return render_template('index.html', response=response['choices'][0]['message']['content'], **context)
-            if response['status']:
+            if response.get('status'):
                 return render_template('index.html', response=response['response'], **context)
             else:
                 return render_template('index.html', response="Something went wrong", **context)
@@ -94,6 +177,181 @@ def index():
     # Render the initial page with the form
     return render_template('index.html', **context)
 
+@app.route('/stream', methods=['POST'])
+def stream_letter():
+    """
+    Same form as the index page, but the letter is sent back as server-sent events while the model
+    writes it. Each event carries a JSON encoded piece of text, and a final done or error event
+    closes the stream.
+    """
+    maker = get_maker()
+    config_name = request.values.get('config') or None
+    if config_name is not None and config_name not in maker.configs:
+        return jsonify({"error": f"no config named {config_name}"}), 404
+    job_data = {
+        "company": request.form['company'],
+        "job_title": request.form['position'],
+        "job_description": request.form['description'],
+        "additional_info": "",
+    }
+    index = maker.resolve_job(job_data)
+    if index is None:
+        return jsonify({"error": "could not store the job"}), 500
+    job = maker.job_data[index]
+
+    def events():
+        try:
+            for text in maker.stream_letter(job, config_name=config_name):
+                yield f"data: {json.dumps(text)}\n\n"
+        except BudgetExceeded as err:
+            app.logger.warning(str(err))
+            yield f"event: error\ndata: {json.dumps(str(err))}\n\n"
+            return
+        except Exception as err:
+            app.logger.exception(f"streaming letter for index {index} failed")
+            yield f"event: error\ndata: {json.dumps(str(err))}\n\n"
+            return
+        yield f"event: done\ndata: {index}\n\n"
+
+    return Response(stream_with_context(events()), mimetype='text/event-stream',
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@app.route('/configs', methods=['GET'])
+def list_configs():
+    store = get_maker().configs
+    return jsonify([{"name": name, "version": store.version(name)} for name in store.names()])
+
+
+def not_modified(etag:str):
+    """
+    A 304 for a request whose If-None-Match already has etag, else None.
+    """
+    if etag in request.if_none_match:
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+    return None
+
+
+@app.route('/jobs', methods=['GET'])
+def list_jobs():
+    """
+    Page through the job database. Takes page, per_page, sort (a field name, - in front for
+    descending), status (generated or pending), company (a case-insensitive substring) and
+    min_cost/max_cost on the total spent per job. Rows come from the in-memory listing, and the
+    ETag changes only when the database is written.
+    """
+    maker = get_maker()
+    args = request.args
+    try:
+        params = {
+            "page": args.get('page', 1, type=int),
+            "per_page": args.get('per_page', 50, type=int),
+            "sort": args.get('sort', "index"),
+            "status": args.get('status') or None,
+            "company": args.get('company') or None,
+            "min_cost": float(args['min_cost']) if args.get('min_cost') else None,
+            "max_cost": float(args['max_cost']) if args.get('max_cost') else None,
+            }
+    except ValueError:
+        return jsonify({"error": "min_cost and max_cost must be numbers"}), 400
+
+    etag = maker.data_obj.listing.etag(*sorted(params.items()))
+    cached = not_modified(etag)
+    if cached is not None:
+        return cached
+    try:
+        result = maker.data_obj.listing.page(**params)
+    except ValueError as err:
+        return jsonify({"error": str(err)}), 400
+    if params['page'] < result['pages']:
+        result['next'] = url_for('list_jobs', **{**args.to_dict(), "page": params['page'] + 1})
+    if params['page'] > 1:
+        result['prev'] = url_for('list_jobs', **{**args.to_dict(), "page": params['page'] - 1})
+    response = jsonify(result)
+    response.set_etag(etag)
+    return response
+
+
+@app.route('/jobs/<int:index>', methods=['GET'])
+def job_detail(index):
+    """
+    One job with its description and every letter written for it.
+    """
+    maker = get_maker()
+    if not 0 <= index < len(maker.job_data):
+        return jsonify({"error": "unknown job"}), 404
+    record = maker.job_data[index]
+    etag = record_etag(record)
+    cached = not_modified(etag)
+    if cached is not None:
+        return cached
+    response = jsonify(detail(record))
+    response.set_etag(etag)
+    return response
+
+
+@app.route('/jobs', methods=['POST'])
+def submit_job():
+    """
+    Queue a letter for background generation. Takes JSON or form data with either an index into the
+    job database or company/job_title/job_description fields, and answers 202 with the URLs to
+    poll.
+    """
+    payload = request.get_json(silent=True) or request.form.to_dict()
+    if 'position' in payload:
+        payload['job_title'] = payload.pop('position')
+    if 'description' in payload:
+        payload['job_description'] = payload.pop('description')
+    payload.pop('get_letter', None)
+    if 'index' in payload:
+        try:
+            payload['index'] = int(payload['index'])
+        except ValueError:
+            return jsonify({"error": "index must be an integer"}), 400
+    elif not all(payload.get(k) for k in ('company', 'job_title', 'job_description')):
+        return jsonify({"error": "send an index or company, job_title and job_description"}), 400
+    if payload.get('config') and payload['config'] not in get_maker().configs:
+        return jsonify({"error": f"no config named {payload['config']}"}), 404
+
+    job_id = get_job_pool().submit(payload)
+    return jsonify({
+        "id": job_id,
+        "status": "queued",
+        "status_url": url_for('job_status', job_id=job_id),
+        "result_url": url_for('job_result', job_id=job_id),
+        }), 202
+
+
+@app.route('/jobs/<uuid:job_id>', methods=['GET'])
+def job_status(job_id):
+    job = get_job_pool().queue.get(str(job_id))
+    if job is None:
+        return jsonify({"error": "unknown job"}), 404
+    job.pop('result')
+    return jsonify(job)
+
+
+@app.route('/jobs/<uuid:job_id>/result', methods=['GET'])
+def job_result(job_id):
+    job = get_job_pool().queue.get(str(job_id))
+    if job is None:
+        return jsonify({"error": "unknown job"}), 404
+    if job['status'] in ('queued', 'running'):
+        return jsonify({"id": job['id'], "status": job['status']}), 202
+    return jsonify({"id": job['id'], "status": job['status'], "result": job['result'], "error": job['error']})
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """
+    Prometheus text format by default, ?format=json for a summary with histogram means.
+    """
+    if request.args.get('format') == 'json':
+        return jsonify(metrics.snapshot())
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
 if __name__ == '__main__':
     app.run()
 